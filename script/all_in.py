@@ -29,20 +29,96 @@ Example:
 """
 
 import argparse
+import copy
 from datetime import datetime
+import functools
+import hashlib
 import logging
+import lzma
 import os
+from pathlib import Path
 import pickle
 from pprint import pformat
 import re
+import shutil
 import sys
 from typing import Dict, List, NoReturn, Tuple, Optional, Union
 
-from ruamel.yaml import YAML
+try:
+    # PyYAML with libyaml (C implementation)
+    import yaml
+    from yaml import CSafeLoader
+except ImportError:
+    # pure python fallback
+    from ruamel.yaml import YAML
+    CSafeLoader = None
+
+# Settings are always read as YAML 1.2 (same as ruamel.yaml):
+# yes/no/on/off are strings, 010 is 10, and 1:30 is a string.
+# Cache entries are keyed with this tag, so that they do not mix between schemas.
+YAML_SCHEMA = "yaml12"
+
+if CSafeLoader is not None:
+    class _Yaml12Loader(CSafeLoader):
+        """CSafeLoader whose plain scalars are resolved by YAML 1.2 core schema.
+        """
+        def construct_yaml12_int(self, node) -> int:
+            value = self.construct_scalar(node).replace('_', '')
+            sign = -1 if value[0] == '-' else 1
+            value = value.lstrip('+-')
+            if value.startswith('0b'):
+                return sign * int(value[2:], 2)
+            elif value.startswith('0o'):
+                return sign * int(value[2:], 8)
+            elif value.startswith('0x'):
+                return sign * int(value[2:], 16)
+            return sign * int(value)
+
+    # Replace YAML 1.1 bool/int/float resolvers
+    _Yaml12Loader.yaml_implicit_resolvers = {
+        first: [
+            (tag, regexp) for tag, regexp in resolvers
+            if tag not in (
+                "tag:yaml.org,2002:bool", "tag:yaml.org,2002:int", "tag:yaml.org,2002:float"
+            )
+        ] for first, resolvers in CSafeLoader.yaml_implicit_resolvers.items()
+    }
+    _Yaml12Loader.add_implicit_resolver(
+        "tag:yaml.org,2002:bool",
+        re.compile(r"^(?:true|True|TRUE|false|False|FALSE)$"),
+        list("tTfF")
+    )
+    _Yaml12Loader.add_implicit_resolver(
+        "tag:yaml.org,2002:int",
+        re.compile(r"^(?:[-+]?0b[0-1_]+|[-+]?0o[0-7_]+|[-+]?[0-9_]+|[-+]?0x[0-9a-fA-F_]+)$"),
+        list("-+0123456789")
+    )
+    _Yaml12Loader.add_implicit_resolver(
+        "tag:yaml.org,2002:float",
+        re.compile(
+            r"^(?:[-+]?(?:[0-9][0-9_]*)\.[0-9_]*(?:[eE][-+]?[0-9]+)?"
+            r"|[-+]?(?:[0-9][0-9_]*)(?:[eE][-+]?[0-9]+)"
+            r"|[-+]?\.[0-9_]+(?:[eE][-+]?[0-9]+)?"
+            r"|[-+]?\.(?:inf|Inf|INF)|\.(?:nan|NaN|NAN))$"
+        ),
+        list("-+0123456789.")
+    )
+    _Yaml12Loader.add_constructor(
+        "tag:yaml.org,2002:int", _Yaml12Loader.construct_yaml12_int
+    )
+try:
+    import zstandard as zstd
+except ImportError:
+    # checkpoints are compressed by lzma instead
+    zstd = None
 
-import all_in_tools as tools
+# Tool modules (cutadapt, fastp, ...) are imported in each step
 from all_in_tools.my_types import *
 
+# magic numbers of compressed checkpoints
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+
 class ExitHandler(logging.FileHandler):
     """Exit when this handler catch the message.
     """
@@ -55,11 +131,11 @@ class ExitHandler(logging.FileHandler):
         print(chr(7))
         exit(1)
 
-def get_args() -> argparse.Namespace:
-    """Read given arguments.
+def _build_parser() -> argparse.ArgumentParser:
+    """Construct the parser of arguments.
 
     returns:
-        argparse.Namespace : given arguments from commandline.
+        argparse.ArgumentParser : parser for all_in.py
     """
 
     # Create new ArgumentParser
@@ -122,51 +198,165 @@ def get_args() -> argparse.Namespace:
         metavar="/path/to/settings.yaml"
     )
 
+    return parser
+
+# The parser is constructed only once
+_PARSER = _build_parser()
+
+def get_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Read given arguments.
+
+    arguments:
+        argv(list of str, optional): arguments. sys.argv[1:] if None.
+
+    returns:
+        argparse.Namespace : given arguments from commandline.
+    """
     # load arguments
     # if parse_args failed, this raises SystemExit
+    return _PARSER.parse_args(argv)
+
+def _load_yaml_cached(yaml_path: str) -> Dict:
+    """load yaml file, using pickled cache of the parsed data.
+
+    The parsed data is pickled into ``~/.cache/all_in/<key>.yaml12.pkl`` .
+    The file is parsed as YAML 1.2, by libyaml if PyYAML is installed, otherwise by ruamel.yaml.
+    <key> is sha1 of the file content, so the yaml parser runs only when the file changes.
+    If the first line of the file is ``# content-version: <version>`` ,
+    <key> is ``<sha1 of the real path>-<version>`` and hashing the content is skipped.
+    (<version> must consist of [0-9A-Za-z._-], otherwise the content sha1 is used.)
+
+    arguments:
+        yaml_path(str) : where the yaml file is.
+
+    return:
+        dict: yaml data.
+    """
+    # read raw content (FileNotFoundError is handled by the caller)
+    with open(yaml_path, 'rb') as f:
+        data = f.read()
+
+    # get cache key
+    # (the version is trusted only with the path, so that a copied header is not shared)
+    matched = re.match(rb"#\s*content-version:[ \t]*([0-9A-Za-z._-]+)[ \t]*(?:\r?\n|$)", data)
+    if matched:
+        path_digest = hashlib.sha1(os.path.realpath(yaml_path).encode()).hexdigest()
+        key = path_digest + "-" + matched.group(1).decode()
+    else:
+        key = hashlib.sha1(data).hexdigest()
+    cache_path = os.path.join(
+        os.path.expanduser("~"), ".cache", "all_in", key + "." + YAML_SCHEMA + ".pkl"
+    )
 
-    args = parser.parse_args()
+    # cache hit
+    try:
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    # cache miss: parse yaml (as YAML 1.2) and save the result
+    if CSafeLoader is not None:
+        parsed = yaml.load(data, Loader=_Yaml12Loader)
+    else:
+        parsed = YAML(typ='safe').load(data.decode('utf-8'))
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(parsed, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # cache is optional
+        pass
+
+    return parsed
+
+def _mtime(path: Optional[str]) -> Optional[float]:
+    """mtime of the file (None if the file does not exist)"""
+    try:
+        return os.path.getmtime(path) if path is not None else None
+    except OSError:
+        return None
+
+def _deep_merge(default: Dict, override: Dict) -> Dict:
+    """marge two settings.
+
+    Values in override take priority, and keys only in override are kept.
+    If both values are dict (e.g. data, logging_config),
+    they are marged recursively, so that the user can override only a part of them.
+
+    arguments:
+        default(dict): default settings.
+        override(dict): user settings.
 
-    # return args(Namespace)
-    return args
+    return:
+        dict: marged settings.
+    """
+    merged = {**default, **override}
+    for key, value in default.items():
+        if isinstance(value, dict) and isinstance(override.get(key), dict):
+            merged[key] = _deep_merge(value, override[key])
+    return merged
 
 def read_settings(yaml_path : str) -> Dict:
     """read ``settings.yaml`` from yaml_path.
 
+    Results are cached while both yaml_path and ``default.yaml`` are unchanged (mtime).
+
     arguments:
         yaml_path(str) : where the yaml file is.
 
     return:
-        dict: yaml data.
+        dict: yaml data (a copy, free to modify).
     """
-    # construct yaml parser
-    yaml = YAML(typ='safe')
+    default_yaml_path = os.path.join(os.path.dirname(__file__),'default.yaml')
+    settings = copy.deepcopy(
+        _read_settings_cached(
+            yaml_path, _mtime(yaml_path), default_yaml_path, _mtime(default_yaml_path)
+        )
+    )
 
+    # threads: null means all CPUs
+    if settings.get("threads") is None:
+        settings["threads"] = os.cpu_count() or 1
+
+    return settings
+
+@functools.lru_cache(maxsize=16)
+def _read_settings_cached(
+    yaml_path: Optional[str],
+    mtime: Optional[float],
+    default_yaml_path: str,
+    default_mtime: Optional[float]
+    ) -> Dict:
+    """read and marge settings (body of read_settings).
+
+    mtime and default_mtime are not used but a part of the cache key.
+    The returned dict is shared by callers; do not modify it.
+    """
     # load yaml file.
     if yaml_path is not None:
         try:
-            with open(yaml_path, 'rt') as f:
-                user_settings = yaml.load(f)
+            user_settings = _load_yaml_cached(yaml_path)
         except FileNotFoundError:
             user_settings = dict()
+        # empty yaml file
+        if user_settings is None:
+            user_settings = dict()
     else:
         user_settings = dict()
 
     # load default yaml
-    default_yaml_path = os.path.join(os.path.dirname(__file__),'default.yaml')
     try:
-        with open(default_yaml_path, 'rt') as f:
-            default_settings = yaml.load(f)
+        default_settings = _load_yaml_cached(default_yaml_path)
     except FileNotFoundError:
         print("{} not found. abort.".format(default_yaml_path))
         sys.exit(1)
 
     # marge user settings and default settings
     # if user settings exist, override default settings
-    settings = {
-        key: user_settings[key] if key in user_settings else default_settings[key] \
-            for key in default_settings.keys()
-    }
+    settings = _deep_merge(default_settings, user_settings)
 
     return settings
 
@@ -188,14 +378,14 @@ def set_logger(settings: dict, args: argparse.Namespace) -> logging.Logger:
     }
 
     # Prepare log directory
-    if not os.path.exists(settings["logging_path"]):
-        os.makedirs(
-            os.path.dirname(settings["logging_path"])
-        )
+    os.makedirs(settings["logging_path"], exist_ok=True)
 
     # get root logger
+    # (level is the lowest one of handlers, so that disabled debug logs cost nothing)
     logger = logging.getLogger("all_in")
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(
+        min(levels[settings["logfile_level"]], levels[settings["console_level"]])
+    )
 
     # create log handler
     # eh : ExitHandler
@@ -207,7 +397,8 @@ def set_logger(settings: dict, args: argparse.Namespace) -> logging.Logger:
     )
     fh = logging.FileHandler(
         os.path.join(settings["logging_path"], settings["filename"]),
-        mode=settings["logging_config"]["filemode"]
+        mode=settings["logging_config"]["filemode"],
+        delay=True
     )
     ch = logging.StreamHandler()
 
@@ -232,8 +423,8 @@ def set_logger(settings: dict, args: argparse.Namespace) -> logging.Logger:
 
 
     logger.debug("logging configured.")
-    logger.debug("arguments : \n\t{}".format(args))
-    logger.debug("settings : \n\t{}".format(settings))
+    logger.debug("arguments : \n\t%s", args)
+    logger.debug("settings : \n\t%s", settings)
 
     return logger
 
@@ -247,27 +438,21 @@ def construct_path(settings: dict, args: argparse.Namespace) -> Tuple[dict, dict
         tuple(dict,dict): (dict of directory path, dict of fastq path)  
     """
 
-    repo_dir = '/'.join(
-        os.path.dirname(
-            os.path.abspath(__file__)
-        ).split('/')[:-1]
-    )
+    repo_dir = Path(__file__).resolve().parent.parent
     time_prefix = datetime.now().strftime(settings['data']['datetime_format'])
 
     # Path to directory
     dir_dict = {
-        "repo" : repo_dir,
+        "repo" : os.fspath(repo_dir),
         "tag" : [
-        os.path.join(repo_dir, tag) for tag in settings['data']['tag']
+        os.fspath(repo_dir / tag) for tag in settings['data']['tag']
         ],
         "primer" : [
-        os.path.join(repo_dir, primer) for primer in settings['data']['primer']
+        os.fspath(repo_dir / primer) for primer in settings['data']['primer']
         ],
-        "cells" : os.path.join(repo_dir, settings['data']['cells_json']),
-        "destination" : os.path.join(
-            repo_dir,
-            settings['data']['destination'],
-            time_prefix
+        "cells" : os.fspath(repo_dir / settings['data']['cells_json']),
+        "destination" : os.fspath(
+            repo_dir / settings['data']['destination'] / time_prefix
         ),
         "report_dest" : os.path.join(
             settings["fastp_output"],
@@ -275,48 +460,25 @@ def construct_path(settings: dict, args: argparse.Namespace) -> Tuple[dict, dict
         )
     }
 
+    # File name of each fastq (used by every stage)
+    stems = {
+        read : [
+            '.'.join(Path(f).name.split('.')[:2]) for f in getattr(args, read)
+        ] for read in ("R1", "R2")
+    }
+
     # Path to fastq
     fastq_dict = {
         "raw" : {
             "R1" : args.R1, "R2" : args.R2
-        },
-        "tag_removed" : {
-            "R1" : [
-                os.path.join(
-                    dir_dict["destination"], "tag_removed", '.'.join(f.split('/')[-1].split('.')[0:2])
-                    ) for f in args.R1
-            ],
-            "R2" : [
-                os.path.join(
-                    dir_dict["destination"], "tag_removed", '.'.join(f.split('/')[-1].split('.')[0:2])
-                    ) for f in args.R2
-            ]
-        },
-        "primer_removed" : {
-            "R1" : [
-                os.path.join(
-                    dir_dict["destination"], "primer_removed", '.'.join(f.split('/')[-1].split('.')[0:2])
-                    ) for f in args.R1
-            ],
-            "R2" : [
-                os.path.join(
-                    dir_dict["destination"], "primer_removed", '.'.join(f.split('/')[-1].split('.')[0:2])
-                    ) for f in args.R2
-            ]
-        },
-        "fastp" : {
-            "R1" : [
-                os.path.join(
-                    dir_dict["destination"], "fastp", '.'.join(f.split('/')[-1].split('.')[0:2])
-                    ) for f in args.R1
-            ],
-            "R2" : [
-                os.path.join(
-                    dir_dict["destination"], "fastp", '.'.join(f.split('/')[-1].split('.')[0:2])
-                    ) for f in args.R2
-            ]
         }
     }
+    for stage in ("tag_removed", "primer_removed", "fastp"):
+        fastq_dict[stage] = {
+            read : [
+                os.path.join(dir_dict["destination"], stage, stem) for stem in stem_list
+            ] for read, stem_list in stems.items()
+        }
 
     return dir_dict, fastq_dict
 
@@ -358,6 +520,29 @@ def check_file_name(
                 else:
                     _force(p, pattern)
 
+def load_checkpoint(chk_path: PathStr) -> "AllIn":
+    """Load AllIn from the checkpoint.
+
+    The compression (zstd, lzma or none) is detected from the magic number,
+    so checkpoints made by older versions can also be loaded.
+
+    Arguments:
+        chk_path(PathStr): path to the checkpoint file
+    returns:
+        AllIn: pickled AllIn object
+    """
+    with open(chk_path, 'rb') as f:
+        data = f.read()
+
+    if data.startswith(ZSTD_MAGIC):
+        if zstd is None:
+            print("zstandard is required to load {}. abort.".format(chk_path))
+            sys.exit(1)
+        data = zstd.ZstdDecompressor().decompress(data)
+    elif data.startswith(XZ_MAGIC):
+        data = lzma.decompress(data)
+
+    return pickle.loads(data)
 
 class AllIn():
     """Run the script, hold status and progress of this script.
@@ -368,6 +553,7 @@ class AllIn():
         logger(Logger): logger(to CLI and file)
         dir_path(dict): dict of path to directories
         fastq_path(dict): dict of path to fastq sequences
+        steps(list): (function, name) of each step.
         step_counter(int): which step should this object run.
     """
     def __init__(self, args: argparse.Namespace) -> None:
@@ -387,6 +573,12 @@ class AllIn():
         # Construct path to each dir, each fastq
         self.dir_path, self.fastq_path = construct_path(self.settings, args)
 
+        # File names of fastp output (used by assemblers)
+        self._fastp_basenames = {
+            read : [os.path.basename(f) for f in self.fastq_path["fastp"][read]] \
+                for read in ("R1", "R2")
+        }
+
         # Initialize the logger
         self.logger = set_logger(self.settings, args)
 
@@ -402,31 +594,26 @@ class AllIn():
             self.settings.get("pattern_check", "force")
         )
 
-        # Set function list
-        self.step_func = [
-            self._step1,
-            self._step2,
-            self._step3,
-            self._step4,
-            self._step5,
-            self._step6,
-            self._step7,
-            self._step8,
-            self._step9,
-            self._step10
-        ]
-        self.step_name = [
-            "cutadapt_tag",
-            "cutadapt_primer",
-            "fastp",
-            "demultiplex",
-            "assemble_all",
-            "assemble_separete",
-            "blast_all",
-            "blast_separate",
-            "marge_results",
-            "output_results"
+        # Set function list: (function, name) of each step
+        self.steps = [
+            (self._step1, "cutadapt_tag"),
+            (self._step2, "cutadapt_primer"),
+            (self._step3, "fastp"),
+            (self._step4, "demultiplex"),
+            (self._step5, "assemble_all"),
+            (self._step6, "assemble_separete"),
+            (self._step7, "blast_all"),
+            (self._step8, "blast_separate"),
+            (self._step9, "marge_results"),
+            (self._step10, "output_results")
         ]
+
+        # Pipeline mode: step 1-3 are replaced by one step,
+        # and only the output of fastp is materialized
+        if self.settings.get("pipeline_mode", False):
+            self.steps[0:3] = [(self._step1to3, "trim_qc_pipeline")]
+            del self.fastq_path["tag_removed"]
+            del self.fastq_path["primer_removed"]
         
         # Set counter
         self.step_counter = 0
@@ -437,72 +624,91 @@ class AllIn():
         )
 
         # Log current status
-        self.logger.debug(pformat(self.__dict__))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(pformat(self.__dict__))
+
+    def __getstate__(self) -> dict:
+        """Exclude the logger (file handlers) from the checkpoint.
+        """
+        state = self.__dict__.copy()
+        state.pop("logger", None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        """Restore from the checkpoint.
+
+        The logger is not restored here; AllInManager sets it by set_logger.
+        Checkpoints of older versions are converted:
+        step_func/step_name into steps, _fastp_basenames from fastq_path,
+        and settings added since then are filled from default.yaml.
+        """
+        self.__dict__.update(state)
+        self.logger = None
+
+        # settings added after the checkpoint was made
+        self.settings = _deep_merge(read_settings(None), self.settings)
+
+        # (function, name) of each step used to be two lists
+        if "steps" not in state:
+            self.steps = list(zip(state["step_func"], state["step_name"]))
+            del self.step_func, self.step_name
+
+        # File names of fastp output (used by assemblers)
+        if "_fastp_basenames" not in state:
+            self._fastp_basenames = {
+                read : [os.path.basename(f) for f in self.fastq_path["fastp"][read]] \
+                    for read in ("R1", "R2")
+            }
     
     def workflow_generator(self) -> WorkflowFunctionInfo:
-        """Yield dict about workflow function.
+        """Yield infomation about the remaining workflow functions.
 
         returns:
-
-
+            WorkflowFunctionInfo: function, name and step No. of the next step.
+            step_counter is updated when the generator resumes after the step.
         """
-        start = self.step_counter
-        for func, count, name in zip(
-            self.step_func[start:len(self.step_func)],
-            range(start, len(self.step_func)),
-            self.step_name[start:len(self.step_func)]
+        for count, (func, name) in enumerate(
+            self.steps[self.step_counter:], start=self.step_counter
         ):
-            #print("before yield {}".format(name))
-            # yield {
-            #     "function": func,
-            #     "name" : name,
-            #     "step": count+1
-            # }
             yield WorkflowFunctionInfo(
                 function=func,
                 name=name,
                 step=count+1,
             )
-            #print("after yield {}".format(name))
             self.step_counter = count + 1
-            # try:
-            #     self.logger.info("====STEP {}: {}====".format(count+1,name))
-            #     func()
-            # except Exception as e:
-            #     self.logger.exception(e)
-            #     raise e
-            # else:
-            #     self.logger.info("===={} end.====".format(name))
-            #     self.step_counter = count + 1
-            #     yield self.step_counter
 
     def _step1(self) -> None:
         """Cutadapt for tag recognition
         
         """
-        tools.cutadapt.cutadapt_tag(
+        from all_in_tools import cutadapt
+        cutadapt.cutadapt_tag(
             R1_fastq=self.fastq_path["raw"]["R1"],
             R2_fastq=self.fastq_path["raw"]["R2"],
             forward_tag=self.dir_path["tag"][0],
             reverse_tag=self.dir_path["tag"][1],
-            destination=self.dir_path["destination"]
+            destination=self.dir_path["destination"],
+            settings=self.settings
         )
 
     def _step2(self) -> None:
         """Cutadapt for common primer
         """
-        tools.cutadapt.cutadapt_primer(
+        from all_in_tools import cutadapt
+        cutadapt.cutadapt_primer(
             R1_fastq=self.fastq_path["tag_removed"]["R1"],
             R2_fastq=self.fastq_path["tag_removed"]["R2"],
             forward_primer=self.dir_path["primer"][0],
             reverse_primer=self.dir_path["primer"][1],
-            destination=self.dir_path["destination"]
+            destination=self.dir_path["destination"],
+            settings=self.settings
         )
 
     def _step3(self) -> None:
         """Quality filtering by fastp
         """
-        tools.fastp.fastp(
+        from all_in_tools import fastp
+        fastp.fastp(
             R1_fastq=self.fastq_path["primer_removed"]["R1"],
             R2_fastq=self.fastq_path["primer_removed"]["R2"],
             destination=self.dir_path["destination"],
@@ -510,31 +716,51 @@ class AllIn():
             settings=self.settings
         )
 
+    def _step1to3(self) -> None:
+        """Cutadapt(tag) -> Cutadapt(primer) -> fastp connected by pipes
+        """
+        from all_in_tools import pipeline
+        pipeline.run_trim_qc_pipeline(
+            R1_fastq=self.fastq_path["raw"]["R1"],
+            R2_fastq=self.fastq_path["raw"]["R2"],
+            forward_tag=self.dir_path["tag"][0],
+            reverse_tag=self.dir_path["tag"][1],
+            forward_primer=self.dir_path["primer"][0],
+            reverse_primer=self.dir_path["primer"][1],
+            destination=self.dir_path["destination"],
+            report_dest=self.dir_path["report_dest"],
+            settings=self.settings
+        )
+
     def _step4(self) -> None:
         """Demultiplex
         """
-        tools.demultiplex.demultiplex(
+        from all_in_tools import demultiplex
+        demultiplex.demultiplex(
             R1_fastq=self.fastq_path["fastp"]["R1"],
             R2_fastq=self.fastq_path["fastp"]["R2"],
             cells_json=self.settings["data"]["cells_json"],
-            destination=self.dir_path["destination"]
+            destination=self.dir_path["destination"],
+            settings=self.settings
         )
 
     def _step5(self) -> None:
         """Assemble (Using all sequences at one time)
         """
-        tools.assemble.assemble_all(
-            R1_name = [r1.split('/')[-1] for r1 in self.fastq_path["fastp"]["R1"]],
-            R2_name = [r2.split('/')[-1] for r2 in self.fastq_path["fastp"]["R2"]],
+        from all_in_tools import assemble
+        assemble.assemble_all(
+            R1_name = self._fastp_basenames["R1"],
+            R2_name = self._fastp_basenames["R2"],
             destination = self.dir_path["destination"],
             assemble_engine = self.args.engine,
             settings=self.settings
         )
 
     def _step6(self) -> None:
-        tools.assemble.assemble_individually(
-            R1_name = [r1.split('/')[-1] for r1 in self.fastq_path["fastp"]["R1"]],
-            R2_name = [r2.split('/')[-1] for r2 in self.fastq_path["fastp"]["R2"]],
+        from all_in_tools import assemble
+        assemble.assemble_individually(
+            R1_name = self._fastp_basenames["R1"],
+            R2_name = self._fastp_basenames["R2"],
             destination = self.dir_path["destination"],
             assemble_engine = self.args.engine,
             settings=self.settings
@@ -543,7 +769,8 @@ class AllIn():
     def _step7(self) -> None:
         """Blast search(all)
         """
-        self.blast_all: dict[str, Optional[BlastResultInfo]] = tools.blast.blast_all(
+        from all_in_tools import blast
+        self.blast_all: dict[str, Optional[BlastResultInfo]] = blast.blast_all(
             destination = self.dir_path["destination"],
             settings=self.settings
         )
@@ -551,7 +778,8 @@ class AllIn():
     def _step8(self) -> None:
         """Blast search(individual & intersection)
         """
-        self.blast_individual: dict[str, Optional[BlastResultInfo]] = tools.blast.blast_individual(
+        from all_in_tools import blast
+        self.blast_individual: dict[str, Optional[BlastResultInfo]] = blast.blast_individual(
             destination=self.dir_path["destination"],
             settings=self.settings
         )
@@ -573,10 +801,12 @@ class AllIn():
             filter_ = self.settings["filter"]
         else:
             filter_ = None
-        tools.save_result.save_result(
+        from all_in_tools import save_result
+        save_result.save_result(
             self.blast_all,
             self.args.output,
-            filter_
+            filter_,
+            R1_name=self._fastp_basenames["R1"]
         )
 
 class AllInManager():
@@ -589,10 +819,12 @@ class AllInManager():
     def __init__(self, args: dict) -> None:
         self.args = args
 
+        # (digest of the state, path) of the last saved checkpoint
+        self._last_checkpoint: Optional[Tuple[bytes, PathStr]] = None
+
         if args.resume is not None:
             # resume point
-            with open(args.resume, 'rb') as f:
-                self._all_in = pickle.load(f)
+            self._all_in = load_checkpoint(args.resume)
 
             # If override flag is on, reload settings
             if args.override_yaml is not None:
@@ -613,23 +845,34 @@ class AllInManager():
         """
         # step_info is WorkflowFunctionInfo.
         # for each step,
-        # - save current status
+        # - save current status (if the step is in checkpoint_before)
         # - log step No. and name
         # - run the step
-        # - report exception if it occurs
+        # - save the checkpoint "failed_<name>" (resumes from the failed step),
+        #   then report exception and stop the workflow if it occurs
+        #   (the checkpoint comes first: ExitHandler exits on ERROR)
+        #   Tool failures are logged by logger.error in the step,
+        #   so SystemExit from ExitHandler is also caught and re-raised.
         # - log end of the step
+        # checkpoint_before: names of steps to save checkpoint before (None: all)
+        checkpoint_before = self._all_in.settings.get("checkpoint_before")
         for step_info in self._all_in.workflow_generator():
-            self._create_checkpoint("before_" + step_info.name)
+            if checkpoint_before is None or step_info.name in checkpoint_before:
+                self._create_checkpoint("before_" + step_info.name)
             try:
                 self._all_in.logger.info(
-                    "====step {}: {}====".format(
-                        step_info.step, step_info.name)
-                    )
+                    "====step %d: %s====", step_info.step, step_info.name
+                )
                 step_info.function()
+            except SystemExit:
+                self._create_checkpoint("failed_" + step_info.name)
+                raise
             except Exception as e:
+                self._create_checkpoint("failed_" + step_info.name)
                 self._all_in.logger.exception(e)
+                break
             else:
-                self._all_in.logger.info("step {} end".format(step_info.step))
+                self._all_in.logger.info("step %d end", step_info.step)
         else:
             # Create checkpoint for test
             self._create_checkpoint("after_all")
@@ -637,6 +880,10 @@ class AllInManager():
     def _create_checkpoint(self, name) -> None:
         """Save self._all_in to 'destination/name.checkpoint'
 
+        The checkpoint is compressed by zstd (lzma if zstandard is not installed).
+        If the state is the same as the last saved checkpoint (e.g. failed_<name> after
+        before_<name>), that file is hard-linked (or copied) instead of compressed again.
+
         Arguments:
             name(str): name of the checkpoint
         """
@@ -646,8 +893,32 @@ class AllInManager():
         chk_path = os.path.join(
             self._all_in.dir_path["destination"], name + ".checkpoint"
         )
-        with open(chk_path, 'wb') as f:
-            pickle.dump(self._all_in, f)
+
+        # Written into tmp_path and renamed,
+        # so that a file hard-linked to another checkpoint is never overwritten
+        tmp_path = "{}.{}.tmp".format(chk_path, os.getpid())
+
+        # Serialize, and reuse the last checkpoint if nothing changed
+        data = pickle.dumps(self._all_in, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.sha1(data).digest()
+        if self._last_checkpoint is not None and self._last_checkpoint[0] == digest:
+            last_path = self._last_checkpoint[1]
+            if last_path == chk_path:
+                return
+            try:
+                os.link(last_path, tmp_path)
+            except OSError:
+                shutil.copyfile(last_path, tmp_path)
+        else:
+            # Compress and write
+            if zstd is not None:
+                data = zstd.ZstdCompressor(level=3).compress(data)
+            else:
+                data = lzma.compress(data, preset=1)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+        os.replace(tmp_path, chk_path)
+        self._last_checkpoint = (digest, chk_path)
 
 if __name__ == "__main__":
     # read args
@@ -1,6 +1,22 @@
-from . import cutadapt
-from . import fastp
-from . import demultiplex
-from . import assemble
-from . import blast
-from . import save_result
\ No newline at end of file
+"""Tools used by all_in.py
+
+Submodules are imported when they are accessed for the first time
+(e.g. ``all_in_tools.blast`` or ``from all_in_tools import blast``),
+so that importing all_in_tools.my_types does not load every tool.
+"""
+import importlib
+
+__all__ = [
+    "cutadapt",
+    "fastp",
+    "pipeline",
+    "demultiplex",
+    "assemble",
+    "blast",
+    "save_result"
+]
+
+def __getattr__(name: str):
+    if name in __all__:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -1,15 +1,29 @@
 """Assembler wrapper for all_in.py
 """
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import hashlib
+import json
 import logging
 import os
+import shutil
+import signal
 import subprocess
-from typing import Dict, List, NewType 
+import threading
+from typing import Dict, List, NewType, Optional
 
 from tqdm.std import tqdm
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 from all_in_tools.my_types import *
 
+# buffer size used when fastq files are merged
+COPY_BUFSIZE = 1 << 20
+
 class Assembler():
     """Base class of specific assembler
     """
@@ -18,19 +32,33 @@ class Assembler():
         fasta_name: str,
         R1_path: PathStr,
         R2_path: PathStr,
-        params: List
+        params: List,
+        threads: Optional[int] = None
         ) -> None:
         self.fasta_name = fasta_name
         self.R1_path = R1_path
         self.R2_path = R2_path
         self.params = params
+        self.threads = threads
+
+        # Environment of the assembler process
+        # (thread count for OpenMP/BLAS based assemblers)
+        self.env = os.environ.copy()
+        if threads:
+            self.env["OMP_NUM_THREADS"] = str(threads)
+            self.env["MKL_NUM_THREADS"] = str(threads)
         self.logger = logging.getLogger("all_in.assembler")
         self.logger.debug("instantiating assembler")
         self.logger.debug(
             self.__dict__
         )
     
-    def assemble(self) -> FASTA:
+    def assemble(self) -> Optional[PathStr]:
+        """Execute assembler.
+
+        Returns:
+            PathStr: path to the contigs fasta, or None if there is no contig.
+        """
         NotImplementedError
 
 class Megahit(Assembler):
@@ -39,7 +67,7 @@ class Megahit(Assembler):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
     
-    def assemble(self) -> FASTA:
+    def assemble(self) -> Optional[PathStr]:
         # make path
         # cell_path: path to the cell
         # megahit_general_out: cell/megahit
@@ -61,44 +89,57 @@ class Megahit(Assembler):
             self.R2_path,
             "-o",
             megahit_out,
+            *(["-t", str(self.threads)] if self.threads else []),
             *self.params
         ]
         self.logger.debug("execute {}".format(command_line))
-        # variables for return of proc
-        msg = None
-        return_code = None
+        # Messages of megahit are written into cell/megahit_out/fasta_name.log
+        # (megahit_out/fasta_name itself must not exist before megahit starts)
+        log_path = megahit_out + '.log'
+        res = None
         try:
             # execute
-            proc = subprocess.Popen(
-                command_line,
-                stdin=None,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT
-            )
-
-            # get return from proc
-            msg = proc.stdout.read().decode()
-            return_code = proc.wait()
+            # (megahit runs in its own session, so that megahit_core children
+            #  can be stopped together)
+            with open(log_path, 'wb') as log_fh:
+                proc = subprocess.Popen(
+                    command_line,
+                    stdin=subprocess.DEVNULL,
+                    stdout=log_fh,
+                    stderr=subprocess.STDOUT,
+                    env=self.env,
+                    close_fds=True,
+                    start_new_session=True
+                )
+                try:
+                    return_code = proc.wait()
+                except BaseException:
+                    # e.g. KeyboardInterrupt: stop the whole process group
+                    os.killpg(proc.pid, signal.SIGTERM)
+                    proc.wait()
+                    raise
         except OSError as e:
-            self.logger.error(msg) if msg else None
-            self.logger.error("megahit returns {}".format(return_code)) if return_code else None
             self.logger.exception(e)
-            res = ""
-        else:
-            return_code = proc.wait()
-            self.logger.debug(msg)
+            return res
 
-            # load fasta
-            contigs_path = megahit_out + '/final.contigs.fa'
-            if os.path.exists(contigs_path):
+        if return_code:
+            self.logger.warning("megahit returns {} (see {})".format(return_code, log_path))
+        elif self.logger.isEnabledFor(logging.DEBUG):
+            with open(log_path, 'rt') as f:
+                self.logger.debug(f.read())
+
+        # check fasta
+        contigs_path = megahit_out + '/final.contigs.fa'
+        if os.path.exists(contigs_path):
+            res = contigs_path
+            if self.logger.isEnabledFor(logging.DEBUG):
                 with open(contigs_path, 'rt') as f:
-                    res = f.read()
-                self.logger.debug("{} contig(s) found.".format(len(res.split('\n'))//2))
-            else:
-                self.logger.debug("no contig")
-                res = ""
-        finally:
-            return res
+                    n_contigs = sum(1 for line in f if line.startswith('>'))
+                self.logger.debug("{} contig(s) found.".format(n_contigs))
+        else:
+            self.logger.debug("no contig")
+
+        return res
 
 class Skesa(Assembler):
     pass
@@ -106,6 +147,305 @@ class Skesa(Assembler):
 class Spades(Assembler):
     pass
 
+def _assembler_threads(settings: Dict) -> int:
+    """Threads for one assembler process
+
+    threads_per_sample, or threads divided among parallel_samples if it is null.
+    """
+    if settings.get("threads_per_sample"):
+        return settings["threads_per_sample"]
+    return max(1, settings["threads"] // (settings.get("parallel_samples") or 1))
+
+# assembler name in settings: assembler class
+ASSEMBLERS = {
+    "megahit" : Megahit,
+    "skesa" : Skesa,
+    "spades" : Spades
+}
+
+def _save_contigs(contigs: Optional[PathStr], dest: PathStr) -> None:
+    """Copy contigs fasta to dest (empty file if contigs is None)
+
+    The assembler output directory is kept as it is.
+    """
+    # dest can be a hard link to the assembly cache: never write into it
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    if contigs:
+        shutil.copyfile(contigs, dest)
+    else:
+        open(dest, 'wb').close()
+
+def _link_or_copy(src: PathStr, dest: PathStr) -> None:
+    """Hard link src to dest (copy if link is impossible), replacing dest"""
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+def _feed_fifo(sources: List[PathStr], fifo: PathStr) -> None:
+    """Write fastq files into fifo (body of the writer thread)"""
+    try:
+        _concat_fastq(sources, fifo)
+    except BrokenPipeError:
+        # the reader exited before reading all
+        pass
+
+def _start_fifo_feeders(
+    R1_fastq: List[PathStr],
+    R2_fastq: List[PathStr],
+    tmpR1_path: PathStr,
+    tmpR2_path: PathStr
+    ) -> List[threading.Thread]:
+    """Make tmpR1/tmpR2 named pipes and start threads writing fastq into them"""
+    feeders = []
+    for sources, fifo in ((R1_fastq, tmpR1_path), (R2_fastq, tmpR2_path)):
+        if os.path.lexists(fifo):
+            os.unlink(fifo)
+        os.mkfifo(fifo)
+        feeder = threading.Thread(target=_feed_fifo, args=(sources, fifo), daemon=True)
+        feeder.start()
+        feeders.append(feeder)
+    return feeders
+
+def _stop_fifo_feeders(feeders: List[threading.Thread], fifos: List[PathStr]) -> None:
+    """Wait for the writer threads, then remove named pipes
+
+    If the assembler never opened a pipe, the writer is still blocked in open().
+    Opening and closing the read end releases it (the write fails with EPIPE).
+    """
+    for feeder, fifo in zip(feeders, fifos):
+        if feeder.is_alive():
+            fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            os.close(fd)
+        feeder.join()
+        os.unlink(fifo)
+
+def _assembly_cache_dir(settings: Dict) -> Optional[PathStr]:
+    """Directory of the assembly cache, or None if the cache is disabled"""
+    if not settings.get("assembly_cache", False):
+        return None
+    return settings.get("assembly_cache_dir") or os.path.join(
+        os.path.expanduser("~"), ".cache", "all_in", "assembly"
+    )
+
+def _cache_key(fastq: List[PathStr], assemble_engine: str, params: List) -> str:
+    """Hash of input fastq files, assembler and its parameters
+
+    xxh3_128 is used if xxhash is installed, otherwise blake2b.
+    """
+    h = xxhash.xxh3_128() if xxhash is not None else hashlib.blake2b(digest_size=16)
+    for path in fastq:
+        with open(path, 'rb') as f:
+            for chunk in iter(partial(f.read, COPY_BUFSIZE), b''):
+                h.update(chunk)
+    h.update(json.dumps([assemble_engine, params], sort_keys=True).encode())
+    return h.hexdigest()
+
+def _run_assembler(
+    asm: Assembler,
+    assemble_engine: str,
+    dest: PathStr,
+    cache_dir: Optional[PathStr],
+    key_files: Optional[List[PathStr]] = None
+    ) -> None:
+    """Run assembler and save contigs into dest.
+
+    If cache_dir is given, contigs of the same input and parameters are
+    linked from cache_dir/<key>/contigs.fasta instead of running assembler.
+    Results without contig are not cached.
+
+    Arguments:
+        asm(Assembler): constructed assembler
+        assemble_engine(str): program using assembling. skesa|megahit|spades
+        dest(PathStr): path to save contigs
+        cache_dir(PathStr or None): path to the assembly cache
+        key_files(list of PathStr, optional): files hashed for the cache key
+            (default: R1 and R2 of asm)
+    """
+    logger = logging.getLogger("all_in.asm_function")
+
+    if cache_dir is None:
+        _save_contigs(asm.assemble(), dest)
+        return
+
+    # cache hit
+    key = _cache_key(key_files or [asm.R1_path, asm.R2_path], assemble_engine, asm.params)
+    cached = os.path.join(cache_dir, key, "contigs.fasta")
+    if os.path.exists(cached):
+        logger.debug("assembly cache hit: %s -> %s", cached, dest)
+        _link_or_copy(cached, dest)
+        return
+
+    # cache miss: assemble and save the result
+    contigs = asm.assemble()
+    _save_contigs(contigs, dest)
+    if contigs:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(cached, os.getpid())
+        _link_or_copy(dest, tmp_path)
+        os.replace(tmp_path, cached)
+
+def _parallel_samples(settings: Dict) -> int:
+    """Number of cells assembled at the same time
+
+    null(None) in settings means cpu_count // threads per assembler process.
+    """
+    workers = settings.get("parallel_samples")
+    if not workers:
+        workers = (os.cpu_count() or 1) // _assembler_threads(settings)
+    return max(1, workers)
+
+def _map_cells(assemble_cell, cell_paths: List[PathStr], workers: int, desc: str) -> None:
+    """Call assemble_cell for each cell, in worker processes if workers > 1
+
+    Arguments:
+        assemble_cell(callable): picklable function which takes the path to the cell
+        cell_paths(list of PathStr): path to each cell
+        workers(int): number of worker processes
+        desc(str): description of progress bar
+    """
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for _ in tqdm(
+                executor.map(assemble_cell, cell_paths),
+                total=len(cell_paths),
+                desc=desc
+            ):
+                pass
+    else:
+        for path in tqdm(cell_paths, desc=desc):
+            assemble_cell(path)
+
+def _scan_cells(destination: PathStr) -> List[PathStr]:
+    """Return path to each cell directory in destination/cells"""
+    cells_dir = os.path.join(destination, "cells")
+    with os.scandir(cells_dir) as it:
+        return [
+            os.path.join(cells_dir, entry.name) for entry in it if entry.is_dir()
+        ]
+
+def _copy_fd(src_fd: int, dst_fd: int) -> None:
+    """Append whole src_fd to dst_fd in kernel if possible
+
+    os.copy_file_range -> os.sendfile -> shutil.copyfileobj
+    """
+    remaining = os.fstat(src_fd).st_size
+    try:
+        while remaining > 0:
+            n = os.copy_file_range(src_fd, dst_fd, remaining)
+            if n == 0:
+                break
+            remaining -= n
+        return
+    except (AttributeError, OSError):
+        pass
+    try:
+        while remaining > 0:
+            n = os.sendfile(dst_fd, src_fd, None, remaining)
+            if n == 0:
+                break
+            remaining -= n
+        return
+    except (AttributeError, OSError):
+        pass
+    # Fallback: continue from the current offset through userspace
+    with open(src_fd, 'rb', closefd=False) as f_src, open(dst_fd, 'wb', closefd=False) as f_dst:
+        shutil.copyfileobj(f_src, f_dst, COPY_BUFSIZE)
+
+def _concat_fastq(sources: List[PathStr], dest: PathStr) -> None:
+    """Concatenate fastq files into dest
+
+    Arguments:
+        sources(list of PathStr): path to each fastq
+        dest(PathStr): path to the merged fastq (overwritten)
+    """
+    dst_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for source in sources:
+            src_fd = os.open(source, os.O_RDONLY)
+            try:
+                # Hint sequential read for larger read-ahead
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                _copy_fd(src_fd, dst_fd)
+            finally:
+                os.close(src_fd)
+    finally:
+        os.close(dst_fd)
+
+def _assemble_one_cell(
+    path: PathStr,
+    R1_name: List[str],
+    R2_name: List[str],
+    assemble_engine: str,
+    params: List,
+    threads: Optional[int],
+    cache_dir: Optional[PathStr] = None,
+    fifo: bool = False
+    ) -> PathStr:
+    """Assemble all sequences in one cell.
+
+    Arguments:
+        path(PathStr): path to the cell
+        R1_name(list of str): filenames in str
+        R2_name(list of str): filenames in str
+        assemble_engine(str): program using assembling. skesa|megahit|spades
+        params(list): parameters passed to the assembler
+        threads(int or None): threads used by the assembler
+        cache_dir(PathStr or None): path to the assembly cache (None: disabled)
+        fifo(bool): pass merged fastq to the assembler through named pipes
+
+    Returns:
+        PathStr: path to all_contigs.fasta
+
+    Note:
+        This runs in worker processes, so the assembler is given by its name.
+    """
+    # Construct path to each file
+    tmpR1_path = os.path.join(path, "tmp_R1.fastq")
+    tmpR2_path = os.path.join(path, "tmp_R2.fastq")
+    R1_fastq = [os.path.join(path, name) for name in R1_name]
+    R2_fastq = [os.path.join(path, name) for name in R2_name]
+    final_contigs_path = os.path.join(path, "all_contigs.fasta")
+
+    # Make temporary fastq (or named pipes fed while assembling)
+    # One pair is passed to the assembler as it is
+    if len(R1_fastq) == 1:
+        fifo = False
+        R1_input, R2_input = R1_fastq[0], R2_fastq[0]
+    else:
+        R1_input, R2_input = tmpR1_path, tmpR2_path
+        if fifo:
+            feeders = _start_fifo_feeders(R1_fastq, R2_fastq, tmpR1_path, tmpR2_path)
+        else:
+            _concat_fastq(R1_fastq, tmpR1_path)
+            _concat_fastq(R2_fastq, tmpR2_path)
+
+    # construct assembler
+    asm = ASSEMBLERS[assemble_engine](
+        fasta_name = "all",
+        R1_path = R1_input,
+        R2_path = R2_input,
+        params = params,
+        threads = threads
+    )
+
+    # Execute assembler and save contigs
+    # (cache key is made from the original fastq, which never blocks)
+    try:
+        _run_assembler(
+            asm, assemble_engine, final_contigs_path, cache_dir,
+            key_files=R1_fastq + R2_fastq
+        )
+    finally:
+        if fifo:
+            _stop_fifo_feeders(feeders, [tmpR1_path, tmpR2_path])
+
+    return final_contigs_path
+
 def assemble_all(
     R1_name: List[str],
     R2_name: List[str],
@@ -115,6 +455,8 @@ def assemble_all(
     ) -> None:
     """Assemble all sequences in one cell.
 
+    Cells are assembled in settings["parallel_samples"] processes at the same time.
+
     Arguments:
         R1_name(list of str): filenames in str
         R2_name(list of str): filenames in str
@@ -125,53 +467,81 @@ def assemble_all(
     logger = logging.getLogger("all_in.asm_function")
     logger.debug("assemble_all called.")
 
-
-    # Select assembler
-    try:
-        selected_assembler = {
-            "megahit" : Megahit,
-            "skesa" : Skesa,
-            "spades" : Spades
-        }[assemble_engine]
-    except KeyError as e:
+    # Check assembler
+    if assemble_engine not in ASSEMBLERS:
+        e = KeyError(assemble_engine)
         logger.exception(e)
         raise e
-    
-    # Scan "cells" directory
-    cells_dir = os.path.join(destination, "cells")
-    with os.scandir(cells_dir) as it:
-        for entry in tqdm(list(it), desc="assemble all"):
-            if entry.is_dir():
-                # Construct path to the cell and each file
-                path = os.path.join(cells_dir, entry.path.split('/')[-1])
-                tmpR1_path = os.path.join(path, "tmp_R1.fastq")
-                tmpR2_path = os.path.join(path, "tmp_R2.fastq")
-                R1_fastq = [os.path.join(path, name) for name in R1_name]
-                R2_fastq = [os.path.join(path, name) for name in R2_name]
-                final_contigs_path = os.path.join(path, "all_contigs.fasta")
-
-                # Make temporary fastq
-                with open(tmpR1_path, 'wt') as f_tmp1, open(tmpR2_path, 'wt') as f_tmp2:
-                    # read each fastq and marge into temporary fastq
-                    for R1, R2 in zip(R1_fastq, R2_fastq):
-                        with open(R1, 'rt') as f_r1, open(R2, 'rt') as f_r2:
-                            f_tmp1.write('\n'.join(f_r1.read().split('\n')[:-1]))
-                            f_tmp2.write('\n'.join(f_r2.read().split('\n')[:-1]))
-                
-                # construct assembler
-                asm = selected_assembler(
-                    fasta_name = "all",
-                    R1_path = tmpR1_path,
-                    R2_path = tmpR2_path,
-                    params = settings[assemble_engine]
-                )
 
-                # Execute assembler
-                contigs = asm.assemble()
+    # Assemble each cell
+    assemble_cell = partial(
+        _assemble_one_cell,
+        R1_name=R1_name,
+        R2_name=R2_name,
+        assemble_engine=assemble_engine,
+        params=settings[assemble_engine],
+        threads=_assembler_threads(settings),
+        cache_dir=_assembly_cache_dir(settings),
+        fifo=settings.get("assembly_fifo", False)
+    )
+    _map_cells(
+        assemble_cell, _scan_cells(destination), _parallel_samples(settings), "assemble all"
+    )
+
+def _assemble_cell_individually(
+    path: PathStr,
+    R1_name: List[str],
+    R2_name: List[str],
+    assemble_engine: str,
+    params: List,
+    threads: Optional[int],
+    cache_dir: Optional[PathStr] = None
+    ) -> None:
+    """Assemble each pair of sequences in one cell.
+
+    Arguments:
+        path(PathStr): path to the cell
+        R1_name(list of str): filenames in str
+        R2_name(list of str): filenames in str
+        assemble_engine(str): program using assembling. skesa|megahit|spades
+        params(list): parameters passed to the assembler
+        threads(int or None): threads used by the assembler
+        cache_dir(PathStr or None): path to the assembly cache (None: disabled)
+
+    Note:
+        This runs in worker processes, so the assembler is given by its name.
+    """
+    logger = logging.getLogger("all_in.asm_function")
+
+    # Construct path to each file
+    R1_fastq_path = [os.path.join(path, name) for name in R1_name]
+    R2_fastq_path = [os.path.join(path, name) for name in R2_name]
+    common_name = [os.path.commonprefix([R1.split('.')[0], R2.split('.')[0]])[:-2] for R1,R2 in zip(R1_name, R2_name)]
+    contigs_path = [os.path.join(path, name) + "_ind_contigs.fasta" for name in common_name]
+    logger.debug(
+        "path={}\nR1_fastq_path={}\nR2_fastq_path={}\ncontigs_path={}".format(
+            path, R1_fastq_path, R2_fastq_path, contigs_path
+        )
+    )
+
+    # If all_contigs.fasta has >0 contig(s), skip this cell
+    with open(os.path.join(path, "all_contigs.fasta"), "rt") as f:
+        if len(f.read()) > 0:
+            return
+
+    # Run assembler for each pair
+    for R1, R2, name, contig in zip(R1_fastq_path, R2_fastq_path, common_name, contigs_path):
+        # Construct assembler
+        asm = ASSEMBLERS[assemble_engine](
+            fasta_name=name,
+            R1_path=R1,
+            R2_path=R2,
+            params=params,
+            threads=threads
+        )
 
-                # Save contigs
-                with open(final_contigs_path, 'wt') as f_out:
-                    f_out.write(contigs)
+        # Execute assembler and save contigs
+        _run_assembler(asm, assemble_engine, contig, cache_dir)
 
 def assemble_individually(
     R1_name: List[str],
@@ -182,6 +552,8 @@ def assemble_individually(
     ) -> None:
     """Assemble sequences in one cell individually.
 
+    Cells are assembled in settings["parallel_samples"] processes at the same time.
+
     Arguments:
         R1_name(list of str): filenames in str
         R2_name(list of str): filenames in str
@@ -192,52 +564,22 @@ def assemble_individually(
     logger = logging.getLogger("all_in.asm_function")
     logger.debug("assemble_individually called.")
 
-    # Select assembler
-    try:
-        selected_assembler = {
-            "megahit" : Megahit,
-            "skesa" : Skesa,
-            "spades" : Spades
-        }[assemble_engine]
-    except KeyError as e:
+    # Check assembler
+    if assemble_engine not in ASSEMBLERS:
+        e = KeyError(assemble_engine)
         logger.exception(e)
         raise e
 
-    # Scan "cells" directory
-    cells_dir = os.path.join(destination, "cells")
-    with os.scandir(cells_dir) as it:
-        for entry in tqdm(list(it), desc="assemble individually"):
-            if entry.is_dir():
-                # Construct path to the cell and each file
-                path = os.path.join(cells_dir, entry.path.split('/')[-1])
-                R1_fastq_path = [os.path.join(path, name) for name in R1_name]
-                R2_fastq_path = [os.path.join(path, name) for name in R2_name]
-                common_name = [os.path.commonprefix([R1.split('.')[0], R2.split('.')[0]])[:-2] for R1,R2 in zip(R1_name, R2_name)]
-                contigs_path = [os.path.join(path, name) + "_ind_contigs.fasta" for name in common_name]
-                logger.debug(
-                    "path={}\nR1_fastq_path={}\nR2_fastq_path={}\ncontigs_path={}".format(
-                        path, R1_fastq_path, R2_fastq_path, contigs_path
-                    )
-                )
-
-                # If all_contigs.fasta has >0 contig(s), continue
-                with open(os.path.join(path, "all_contigs.fasta"), "rt") as f:
-                    if len(f.read()) > 0:
-                        continue
-
-                # Run assembler for each pair
-                for R1, R2, name, contig in zip(R1_fastq_path, R2_fastq_path, common_name, contigs_path):
-                    # Construct assembler
-                    asm = selected_assembler(
-                        fasta_name=name,
-                        R1_path=R1,
-                        R2_path=R2,
-                        params=settings[assemble_engine]
-                    )
-
-                    # Execute assembler
-                    contigs_fasta = asm.assemble()
-
-                    # Save contigs
-                    with open(contig, 'wt') as f_out:
-                        f_out.write(contigs_fasta)
\ No newline at end of file
+    # Assemble each cell
+    assemble_cell = partial(
+        _assemble_cell_individually,
+        R1_name=R1_name,
+        R2_name=R2_name,
+        assemble_engine=assemble_engine,
+        params=settings[assemble_engine],
+        threads=_assembler_threads(settings),
+        cache_dir=_assembly_cache_dir(settings)
+    )
+    _map_cells(
+        assemble_cell, _scan_cells(destination), _parallel_samples(settings), "assemble individually"
+    )
@@ -1,22 +1,216 @@
 """Blastn wrapper for all_in.py
 """
-from functools import reduce
+import atexit
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
 from glob import glob
+import io
 import logging
 import os
+import shutil
 import subprocess
 import tempfile
-from typing import Dict, List, Optional, Set, Union
+from typing import IO, Dict, Iterator, List, Optional, Set, Tuple, Union
 import sys
 
 import pandas as pd
+from pandas.api.types import union_categoricals
 from tqdm.std import tqdm
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pacsv = None
 
 if __name__ == "__main__":
     from my_types import *
 else:
     from all_in_tools.my_types import *
 
+# type of blastn output columns (-outfmt 10), used by both pyarrow and pandas
+# (columns not listed here are inferred)
+# float columns stay float64 so that values written into csv are unchanged
+BLAST_COLUMN_TYPES = {
+    "qaccver": "string",
+    "saccver": "string",
+    "pident": "float64",
+    "length": "int32",
+    "mismatch": "int32",
+    "gapopen": "int32",
+    "qstart": "int32",
+    "qend": "int32",
+    "sstart": "int32",
+    "send": "int32",
+    "evalue": "float64",
+    "bitscore": "float64"
+}
+
+# blastn output columns used by blast.py and save_result.py
+BLAST_USED_COLUMNS = ["qaccver", "saccver", "pident", "length", "evalue", "bitscore"]
+
+def _read_blast_csv(
+    f: IO[bytes],
+    header: List[str],
+    columns: Optional[List[str]] = None
+    ) -> pd.DataFrame:
+    """Read blastn output (csv without header) into DataFrame.
+
+    Arguments:
+        f(binary file): blastn output.
+        header(list of str): column names.
+        columns(list of str, optional): columns to keep (default: all of header).
+
+    Returns:
+        pd.DataFrame: blastn result (can be empty).
+
+    Note:
+        pyarrow is used if it is installed, otherwise pandas.
+        Columns not kept are not converted.
+    """
+    columns = [name for name in header if columns is None or name in columns]
+
+    # Empty output means no hit
+    if f.seek(0, os.SEEK_END) == 0:
+        return pd.DataFrame(columns=columns)
+    f.seek(0)
+
+    if pacsv is None:
+        dtype = {
+            name: (str if BLAST_COLUMN_TYPES[name] == "string" else BLAST_COLUMN_TYPES[name])
+            for name in columns if name in BLAST_COLUMN_TYPES
+        }
+        return pd.read_csv(f, names=header, usecols=columns, dtype=dtype, engine="c")
+
+    column_types = {
+        name: getattr(pa, BLAST_COLUMN_TYPES[name])()
+        for name in columns if name in BLAST_COLUMN_TYPES
+    }
+    table = pacsv.read_csv(
+        f,
+        read_options=pacsv.ReadOptions(column_names=header),
+        convert_options=pacsv.ConvertOptions(
+            column_types=column_types, include_columns=columns
+        )
+    )
+    return table.to_pandas()
+
+# tmpfs directory for blastn database (blast_db_in_memory)
+SHM_DIR = "/dev/shm"
+
+def _stage_db_in_memory(params: List) -> List:
+    """Copy the database given by -db into tmpfs and rewrite -db.
+
+    Arguments:
+        params(list): parameters passed to blastn.
+
+    Returns:
+        list: parameters using the copied database.
+        Same as params if the database can not be copied.
+
+    Note:
+        The copy is made once per process and removed when the process exits.
+    """
+    logger = logging.getLogger("all_in.Blastn")
+
+    # Find database files (<db>.nhr, <db>.nin, ...)
+    try:
+        db = params[params.index("-db") + 1]
+    except (ValueError, IndexError):
+        logger.warning("blast_db_in_memory: no -db in blastn parameters")
+        return params
+    db_files = glob(db + ".*")
+    if not os.path.isdir(SHM_DIR) or not db_files:
+        logger.warning("blast_db_in_memory: can not copy {} into {}".format(db, SHM_DIR))
+        return params
+
+    # Check free space
+    db_size = sum(os.path.getsize(f) for f in db_files)
+    if shutil.disk_usage(SHM_DIR).free < db_size:
+        logger.warning("blast_db_in_memory: not enough space in {}".format(SHM_DIR))
+        return params
+
+    # Copy database
+    shm_db_dir = os.path.join(SHM_DIR, "all_in_blastdb_{}".format(os.getpid()))
+    if not os.path.exists(shm_db_dir):
+        os.makedirs(shm_db_dir)
+        atexit.register(shutil.rmtree, shm_db_dir, ignore_errors=True)
+        for f in db_files:
+            shutil.copy(f, shm_db_dir)
+        logger.debug("database {} is copied into {}".format(db, shm_db_dir))
+
+    # Rewrite -db
+    new_params = list(params)
+    new_params[params.index("-db") + 1] = os.path.join(shm_db_dir, os.path.basename(db))
+    return new_params
+
+def _prepare_mb_index(params: List) -> List:
+    """Build megablast index of the -db database if missing, and add -use_index.
+
+    Arguments:
+        params(list): parameters passed to blastn.
+
+    Returns:
+        list: parameters with "-use_index true".
+        Same as params if the index can not be built.
+
+    Note:
+        The index is written next to the database (<db>.00.idx, ...) by makembindex.
+    """
+    logger = logging.getLogger("all_in.Blastn")
+    if "-use_index" in params:
+        return params
+
+    try:
+        db = params[params.index("-db") + 1]
+    except (ValueError, IndexError):
+        logger.warning("blast_use_index: no -db in blastn parameters")
+        return params
+
+    # Build index
+    if not glob(db + ".*.idx"):
+        command_line = ["makembindex", "-input", db, "-iformat", "blastdb"]
+        logger.debug("execute {}".format(command_line))
+        try:
+            proc = subprocess.run(
+                command_line,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT
+            )
+        except OSError as e:
+            logger.warning("blast_use_index: {}".format(e))
+            return params
+        if proc.returncode:
+            logger.warning(proc.stdout.decode(errors="replace"))
+            logger.warning("makembindex returns {}".format(proc.returncode))
+            return params
+
+    return [*params, "-use_index", "true"]
+
+def _iter_fasta(path: PathStr) -> Iterator[Tuple[str, str]]:
+    """Read fasta file record by record.
+
+    Arguments:
+        path(PathStr): path to the fasta file.
+
+    Yields:
+        (str, str): name line (with ">") and sequence.
+        Sequence wrapped in multiple lines is joined.
+    """
+    name = None
+    buf: List[str] = []
+    with open(path, 'rt') as f:
+        for line in f:
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, ''.join(buf)
+                name = line.rstrip()
+                buf = []
+            else:
+                buf.append(line.rstrip())
+    if name is not None:
+        yield name, ''.join(buf)
+
 class Blastn():
     """Blastn search engine.
 
@@ -40,15 +234,25 @@ class Blastn():
         self.logger.debug("instantiating Blastn")
         self.settings = settings
         self.params = params
+        # Use megablast index (built if missing)
+        if settings.get("blast_use_index", False):
+            self.params = _prepare_mb_index(self.params)
+        # Copy database into RAM (tmpfs)
+        if settings.get("blast_db_in_memory", False):
+            self.params = _stage_db_in_memory(self.params)
+        # Use multiple threads unless -num_threads is given by params
+        if "-num_threads" not in self.params:
+            self.params = [*self.params, "-num_threads", str(_blast_threads(settings))]
     
-    def _execute(self, query: PathStr)-> List[BlastResultInfo]:
+    def _execute(self, query: PathStr)-> Tuple[pd.DataFrame, Dict[str, Tuple[str, str]]]:
         """Execute blastn.
 
         Arguments:
             query(PathStr): path to the contig file.
         
         Returns:
-            list of BlastResultInfo: results.
+            (pd.DataFrame, dict): results of all sequences,
+            and qaccver: (name line, sequence) of each sequence.
         
         Note:
             If the fasta file is like below:
@@ -57,115 +261,94 @@ class Blastn():
             >anotherSequence
             atgcgcat
 
-            The result is:
-            [
-                BlastResultInfo(OneSequence),
-                BlastResultInfo(AnotherSequence)
-            ] 
+            The "qaccver" column of the result is OneSequence or anotherSequence.
+            Rows of unknown qaccver are removed.
         """
 
-        # Read query fasta
-        with open(query, 'rt') as f:
-            fasta = f.read().split('\n')[:-1]
-            query_dict = {fasta[i]: fasta[i+1] for i in range(0,len(fasta),2)}
         self.logger.debug(query)
-        self.logger.debug(fasta)
-        self.logger.debug(query_dict)
-        # Prepare result list
-        result = list()
-
-        # Search each sequence
-        for name, seq in query_dict.items():
-            # Work inside the context of tempfile.
-            #with tempfile.TemporaryFile(mode="w+t") as tmp:
-            with open("search_test.csv", "w+t") as tmp_out, tempfile.NamedTemporaryFile('w+t') as tmp_seq:
-                # output sequence to tmp file
-                tmp_seq.write(seq)
-                tmp_seq.seek(0)
-                self.logger.debug(f"query file: \n{tmp_seq.read()}")
-                tmp_seq.seek(0)
-                # Construct command
-                command_line = [
-                    "blastn",
-                    "-query",
-                    tmp_seq.name,
-                    "-outfmt",
-                    "10",
-                    *self.params
-                ]
-                self.logger.debug("command_line: {}".format(command_line))
-
-                self.logger.debug("execute {}".format(command_line))
-                return_code = None
-                try:
-                    # Execute
-                    # Input query seq(PIPE),
-                    # Write result to temporary file(tmp),
-                    # and get error from PIPE 
-                    proc = subprocess.Popen(
-                        command_line,
-                        stdin=None,
-                        stdout=tmp_out,
-                        stderr=subprocess.PIPE
-                    )
-                    # Wait until search finished.
-                    # We will get no stdout
-                    _, err = proc.communicate()
-                    return_code = proc.returncode
-                    # Seek to file head
-                    tmp_out.seek(0)
-
-                except OSError as e:
-                    self.logger.error(err)
-                    self.logger.error("blastn returns {}".format(return_code))
-                    self.logger.exception(e)
-                    raise e
-                else:
-                    self.logger.debug(tmp_out.read())
-                    tmp_out.seek(0)
-                    # Convert csv to DataFrame
-                    result_df = pd.read_csv(tmp_out, names=self.settings["blast_header"])
-                    # Add origin of result to df
-                    result_df["query_file"] = query
-                    result_df["query_name"] = name
-                    result_df["query_seq"] = seq
-                    # Append result of this execution into return list
-                    result.append(
-                        BlastResultInfo(result_df,query,name,seq)
-                    )
-                    # check result (for debug)
-                    result_df.to_csv("1A01.csv")
-        else:
-            self.logger.debug("search end. result: {}".format(result))
-        return result
-
-    def _choose_highest_score(self, blastn_result: BlastResultInfo) -> BlastResultInfo:
-        """Choose best result from blastn output.
-
-        Arguments:
-            blastn_result(BlastResultInfo): result of _execute.
-        
-        Returns:
-            BlastResultInfo: best match.
-        """
-        # sort result by evalue
-        blastn_result.result.sort_values(
-            by=["evalue"], inplace=True)
-        
-        # Get highest evalue and extract result that have highest evalue
-        highest_evalue = blastn_result.result["evalue"].min()
-        highest_bitscore = blastn_result.result["bitscore"].max()
-        self.logger.debug(f"eval={highest_evalue}, bitscore={highest_bitscore}")
-        best_result: BlastResultInfo = BlastResultInfo(
-            blastn_result.result.query(
-                f"evalue == {highest_evalue} and bitscore == {highest_bitscore}"
-            ),
-            blastn_result.query_file,
-            blastn_result.query_name,
-            blastn_result.query_seq
+        # Prepare empty result
+        result = pd.DataFrame(columns=BLAST_USED_COLUMNS), dict()
+
+        # Map blastn "qaccver" (first word of the name line) to the record
+        # (hits of a sequence without name are removed as unknown qaccver)
+        records: Dict[str, Tuple[str, str]] = dict()
+        for name, seq in _iter_fasta(query):
+            words = name[1:].split()
+            if words:
+                records[words[0]] = (name, seq)
+            else:
+                self.logger.warning("sequence without name in {} is skipped".format(query))
+        if not records:
+            self.logger.debug("no sequence in {}".format(query))
+            return result
+        result = result[0], records
+
+        # Search all sequences by one blastn
+        command_line = [
+            "blastn",
+            "-query",
+            query,
+            "-outfmt",
+            "10",
+            *self.params
+        ]
+        self.logger.debug("execute {}".format(command_line))
+        try:
+            # Get result and error from PIPE
+            proc = subprocess.run(
+                command_line,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=self.settings.get("blast_timeout")
+            )
+        except subprocess.TimeoutExpired:
+            # blastn is killed by subprocess.run
+            self.logger.warning(
+                "blastn timed out ({} s): {}".format(self.settings.get("blast_timeout"), query)
+            )
+            return result
+        except OSError as e:
+            self.logger.exception(e)
+            raise e
+        if proc.returncode:
+            self.logger.error(proc.stderr.decode(errors="replace"))
+            self.logger.error("blastn returns {}".format(proc.returncode))
+            return result
+
+        # Convert csv to DataFrame
+        # Columns not used later are dropped unless keep_all_blast_cols
+        result_df = _read_blast_csv(
+            io.BytesIO(proc.stdout),
+            self.settings["blast_header"],
+            None if self.settings.get("keep_all_blast_cols", False) else BLAST_USED_COLUMNS
         )
+        # Subject names are compared many times (intersection): use category codes
+        result_df["saccver"] = result_df["saccver"].astype("category")
+
+        # Remove result of unknown sequence
+        result_df["qaccver"] = result_df["qaccver"].astype(str)
+        known = result_df["qaccver"].isin(records.keys())
+        if not known.all():
+            self.logger.warning(
+                "unknown qaccver {} in {}".format(
+                    list(result_df.loc[~known, "qaccver"].unique()), query
+                )
+            )
+            result_df = result_df[known]
+
+        # Dump result (for debug), instead of the former search_test.csv / 1A01.csv
+        if self.logger.isEnabledFor(logging.DEBUG):
+            cell_name = os.path.basename(os.path.dirname(os.path.abspath(query)))
+            fasta_name = os.path.splitext(os.path.basename(query))[0]
+            debug_csv = os.path.join(
+                tempfile.gettempdir(), "blast_debug_{}_{}.csv".format(cell_name, fasta_name)
+            )
+            result_df.to_csv(debug_csv)
+            self.logger.debug("search end. result: %s", debug_csv)
+
+        return result_df, records
 
-        return best_result
 
     def _get_result_intersection(self, results: List[BlastResultInfo]) ->  Optional[BlastResultInfo]:
         """Return intersection of results.
@@ -185,39 +368,34 @@ class Blastn():
         dfs: List[pd.DataFrame] = [r.result for r in results]
         names: List[Set[str]] = [set(d["saccver"]) for d in dfs]
 
-        # Create union for further convolution process
-        union_names = set()
-        for s in names:
-            union_names = union_names | s
-
-        # Get intersection by convolution
-        # f_and = lambda x,y: x & y
-        # intersection: List[str] = list(reduce(f_and, names, union_names))
-        def f_and(x,y):
-            inter = x & y
-            self.logger.debug(inter)
-            return inter
-        self.logger.debug(f"initial (union={len(union_names)}) : {union_names}")
-        intersection: List[str] = list(reduce(f_and, names, union_names))
-        self.logger.debug(f"final (intersection={len(intersection)}): {intersection}")
+        # Get intersection from the smallest set, and stop as soon as it is empty
+        intersection_set: Set[str] = set()
+        if names:
+            names.sort(key=len)
+            intersection_set = set(names[0])
+            for name_set in names[1:]:
+                intersection_set &= name_set
+                if not intersection_set:
+                    break
+        intersection: List[str] = list(intersection_set)
+        self.logger.debug("intersection=%d: %s", len(intersection), intersection)
 
         if len(intersection) > 0:
-            # Prepare final result DataFrame
-            final_cols = self.settings["blast_header"] + ["query_file", "query_name", "query_seq"]
-            final_df = pd.DataFrame(index=[], columns=final_cols)
-
-            # Append appropriate record("saccver" of record <= intersection ) into final_df
-            # This is maybe a kind of convolution... 
-            for d in dfs:
-                final_df = pd.concat(
-                    [final_df, d[d["saccver"].isin(intersection)]]
-                )
-            
+            # Collect appropriate record("saccver" of record <= intersection ) of each result,
+            # and concatenate them at once
+            final_cols = list(dfs[0].columns)
+            parts = [d.loc[d["saccver"].isin(intersection_set), final_cols] for d in dfs]
+            # Share categories so that saccver stays categorical after concat
+            categories = union_categoricals([p["saccver"] for p in parts]).categories
+            final_df = pd.concat(
+                [p.assign(saccver=p["saccver"].cat.set_categories(categories)) for p in parts]
+            )
+
             # Remove duplicated records
-            # Save one has highest evalue
-            final_df.sort_values(by=["evalue"], inplace=True)
-            final_df.to_csv("final_before_drop.csv")
-            final_df.drop_duplicates(subset="saccver", keep="first", inplace=True)
+            # Save one has highest evalue (stable sort: earlier result wins a tie)
+            final_df = final_df.sort_values(by="evalue", kind="mergesort").drop_duplicates(
+                subset="saccver", keep="first"
+            )
 
             # set query_file, query_name, and query_seq by convined name
             final_query_file = ":".join(list(final_df["query_file"].unique()))
@@ -251,34 +429,109 @@ class Blastn():
         """
         # Execute blastn
         self.logger.debug("_blast_search_single called")
-        search_result: List[BlastResultInfo] = self._execute(query)
-
-        # Extract highest score 
-        if len(search_result) > 0:
-            top_list: List[BlastResultInfo] = []
-            for r in search_result:
-                # skip empty dataframe
-                if r.result.empty:
-                    continue
-                top_list.append(self._choose_highest_score(r))
-            else:
-                if top_list: # if there is more than zero result(s)
-                    # Select df that has highest e-value among top_list 
-                    highest = min(
-                        top_list,
-                        key=(lambda x: x.result["evalue"].min())
-                    )
-                    res = highest
-                    self.logger.debug("top_list: {}".format(top_list))
-                    self.logger.debug("highest: {}".format(highest.result))
-                else: # If there is no valid result
-                    res = None
-        else:
+        result_df, records = self._execute(query)
+        return self._best_hit(result_df, records, query)
+
+    def _best_hit(
+        self,
+        result_df: pd.DataFrame,
+        records: Dict[str, Tuple[str, str]],
+        query: PathStr
+        ) -> Optional[BlastResultInfo]:
+        """Select best match from the result of one fasta file.
+
+        Arguments:
+            result_df(pd.DataFrame): results of the sequences in the file.
+            records(dict): qaccver: (name line, sequence) of each sequence.
+            query(PathStr): path to the query fasta file.
+
+        Returns:
+            BlastResultInfo: best match.
+
+        Note:
+            This is a private function.
+        """
+        if result_df.empty:
             # If there is no hit, return None
-            res = None
+            return None
+
+        # Best rows of each sequence: lowest evalue and highest bitscore in the sequence
+        by_query = result_df.groupby("qaccver", sort=False)
+        lowest_evalue = by_query["evalue"].transform("min")
+        highest_bitscore = by_query["bitscore"].transform("max")
+        best = result_df[
+            (result_df["evalue"] == lowest_evalue) & (result_df["bitscore"] == highest_bitscore)
+        ]
+        if best.empty:
+            # If there is no valid result
+            return None
+
+        # Select the sequence that has highest e-value
+        # (first one in the fasta if tied)
+        winner = best.at[best["evalue"].idxmin(), "qaccver"]
+        name, seq = records[winner]
+        res = BlastResultInfo(
+            best[best["qaccver"] == winner].assign(
+                query_file=query, query_name=name, query_seq=seq
+            ),
+            query,
+            name,
+            seq
+        )
+        self.logger.debug("highest: %s", res.result)
 
         return res
 
+    def _blast_search_combined(self, query_list: List[PathStr]) -> List[BlastResultInfo]:
+        """Search all sequences of the files by one blastn, and return best match of each file.
+
+        Arguments:
+            query_list(list of PathStr): path to the query fasta file.
+
+        Returns:
+            list of BlastResultInfo: best match of each file (files without hit are skipped).
+
+        Note:
+            This is a private function.
+            Sequences are renamed F<file>S<sequence> in the combined fasta,
+            so that the results are split by file afterwards.
+        """
+        self.logger.debug("_blast_search_combined called")
+
+        # Write all sequences into one fasta (next to the queries)
+        sources: Dict[str, Tuple[int, str, str]] = dict()
+        with tempfile.NamedTemporaryFile(
+            'wt', suffix=".fasta", prefix="combined_",
+            dir=os.path.dirname(query_list[0]), delete=False
+            ) as f:
+            for i, query in enumerate(query_list):
+                for j, (name, seq) in enumerate(_iter_fasta(query)):
+                    if not name[1:].split():
+                        self.logger.warning("sequence without name in {} is skipped".format(query))
+                        continue
+                    qid = "F{}S{}".format(i, j)
+                    sources[qid] = (i, name, seq)
+                    f.write(">{}\n{}\n".format(qid, seq))
+        try:
+            result_df, _ = self._execute(f.name)
+        finally:
+            os.unlink(f.name)
+        if result_df.empty:
+            return []
+
+        # Split by file and restore original qaccver
+        file_index = result_df["qaccver"].map(lambda qid: sources[qid][0])
+        individual_result: List[BlastResultInfo] = list()
+        for i, file_df in result_df.groupby(file_index, sort=True):
+            records = {
+                qid: sources[qid][1:] for qid in file_df["qaccver"].unique()
+            }
+            res = self._best_hit(file_df, records, query_list[i])
+            if res is not None:
+                res.result["qaccver"] = res.query_name[1:].split()[0]
+                individual_result.append(res)
+        return individual_result
+
     def _blast_search_multi(self, query_list: List[PathStr]) -> Optional[BlastResultInfo]:
         """Execute blast search and return best result.
 
@@ -298,17 +551,16 @@ class Blastn():
         self.logger.debug("_blast_search_multi called.")
         self.logger.debug(query_list)
 
-        # List for result
+        # List for result (files without hit are skipped)
+        # Several files are searched by one blastn, to load the database once
         individual_result: List[BlastResultInfo] = list()
-
-        for query in query_list:
-            individual_result.append(
-                self._blast_search_single(query)
-            )
+        if len(query_list) > 1:
+            individual_result = self._blast_search_combined(query_list)
         else:
-            # Remove None
-            filter_none = lambda x: True if x is not None else False
-            individual_result = list(filter(filter_none, individual_result))
+            individual_result = [
+                result for result in map(self._blast_search_single, query_list)
+                if result is not None
+            ]
 
         # Extract result from individual_result        
         final_result = None
@@ -342,48 +594,108 @@ class Blastn():
             self.logger.error("blast_search got {}: why?".format(type(query)))
             return None
 
-def blast_all(
+def _blast_threads(settings: Dict) -> int:
+    """Threads for one blastn process (blast_threads, or threads if not set)"""
+    return settings.get("blast_threads") or settings.get("threads") or os.cpu_count() or 1
+
+def _blast_cell(
+    cell_name: str,
+    cells_dir: PathStr,
+    blast: Blastn,
+    individual: bool
+    ) -> Tuple[str, Optional[BlastResultInfo]]:
+    """Blastn search for one cell.
+
+    Arguments:
+        cell_name(str): name of the cell directory
+        cells_dir(PathStr): path to the cells directory
+        blast(Blastn): search engine
+        individual(bool): use *_ind_contigs.fasta instead of all_contigs.fasta
+
+    Returns:
+        (str, Optional[BlastResultInfo]): cell_name and result of blast search
+    """
+    if individual:
+        query = glob(
+            os.path.join(cells_dir, cell_name, "*_ind_contigs.fasta")
+        )
+    else:
+        query = os.path.join(cells_dir, cell_name, "all_contigs.fasta")
+    return cell_name, blast.blast_search(query)
+
+def _blast_cells(
     destination: PathStr,
-    settings: Dict
+    settings: Dict,
+    individual: bool,
+    desc: str
     ) -> Dict[str, Union[BlastResultInfo, None]]:
-    """Blastn search, using all_contigs.fasta
-    
+    """Blastn search for each cell, in settings["parallel_samples"] processes
+
     Arguments:
         destination(PathStr): path to the data folder
         settings(dict): settings from yaml
+        individual(bool): use *_ind_contigs.fasta instead of all_contigs.fasta
+        desc(str): description of progress bar
 
     Returns:
         dict[str: Optional[BlastResultInfo]]: cell_name: result of blast search
+
+    Note:
+        null(None) of parallel_samples means cpu_count // blast threads.
+        If parallel_samples is given and blast_threads is null,
+        threads are divided among the processes.
     """
-    logger = logging.getLogger("all_in.blast_all")
-    logger.debug("assemble_all called.")
+    # Number of processes
+    workers = settings.get("parallel_samples") or (os.cpu_count() or 1) // _blast_threads(settings)
 
     # Initialize blast
-
+    params = settings["blastn"]
+    if workers > 1 and not settings.get("blast_threads") and "-num_threads" not in params:
+        params = [*params, "-num_threads", str(max(1, _blast_threads(settings) // workers))]
     blast = Blastn(
         settings=settings,
-        params=settings["blastn"]
+        params=params
     )
 
-    # Initialize result dict
-    result_dict = dict()
-
     # Scan cells directory
     cells_dir = os.path.join(destination, "cells")
     with os.scandir(cells_dir) as it:
-        for entry in tqdm(list(it), desc="blast search (all)"):
-            if entry.is_dir():
-                # Get cell name and the fasta file of final contigs
-                cell_name = entry.path.split('/')[-1]
-                contigs_path = os.path.join(cells_dir, cell_name, "all_contigs.fasta")
+        cell_names = sorted(entry.name for entry in it if entry.is_dir())
 
-                # Execute search
-                res = blast.blast_search(contigs_path)
+    # Execute search
+    search_cell = partial(
+        _blast_cell, cells_dir=cells_dir, blast=blast, individual=individual
+    )
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(search_cell, name) for name in cell_names]
+            results = [
+                f.result() for f in tqdm(as_completed(futures), total=len(futures), desc=desc)
+            ]
+    else:
+        results = [search_cell(name) for name in tqdm(cell_names, desc=desc)]
 
-                # Update result
-                result_dict[cell_name] = res
+    # Keep the order of cells
+    result_dict = dict(results)
+    return {name: result_dict[name] for name in cell_names}
 
-    return result_dict
+def blast_all(
+    destination: PathStr,
+    settings: Dict
+    ) -> Dict[str, Union[BlastResultInfo, None]]:
+    """Blastn search, using all_contigs.fasta
+    
+    Arguments:
+        destination(PathStr): path to the data folder
+        settings(dict): settings from yaml
+
+    Returns:
+        dict[str: Optional[BlastResultInfo]]: cell_name: result of blast search
+    """
+    logger = logging.getLogger("all_in.blast_all")
+    logger.debug("blast_all called.")
+
+    return _blast_cells(destination, settings, False, "blast search (all)")
 
 def blast_individual(
     destination: PathStr,
@@ -399,37 +711,12 @@ def blast_individual(
         dict[str: Optional[BlastResultInfo]]: cell_name: result of blast search
     """
     logger = logging.getLogger("all_in.blast_individual")
-    logger.debug("assemble_individual called.")
+    logger.debug("blast_individual called.")
 
-    # Initialize blast
-
-    blast = Blastn(
-        settings=settings,
-        params=settings["blastn"]
+    return _blast_cells(
+        destination, settings, True, "blast search (individual & intersection)"
     )
 
-    # Initialize result dict
-    result_dict = dict()
-
-    # Scan cells directory
-    cells_dir = os.path.join(destination, "cells")
-    with os.scandir(cells_dir) as it:
-        for entry in tqdm(list(it), desc="blast search (individual & intersection)"):
-            if entry.is_dir():
-                # Get cell name and the fasta file of final contigs
-                cell_name = entry.path.split('/')[-1]
-                contigs_path_list = glob(
-                    os.path.join(cells_dir, cell_name, "*_ind_contigs.fasta")
-                )
-
-                # Execute blastn
-                res = blast.blast_search(contigs_path_list)
-
-                # Update result
-                result_dict[cell_name] = res
-    
-    return result_dict
-
 if __name__ == "__main__":
     # test
     logging.basicConfig(level=logging.DEBUG, filename="blast.log", filemode="w")
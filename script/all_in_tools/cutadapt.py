@@ -1,16 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
 import subprocess
-from typing import List
+from typing import Dict, List
 
+from all_in_tools.fastq_io import fastq_name
 from all_in_tools.my_types import *
 
+def _parallel_pairs(settings: Dict, n_pairs: int) -> int:
+    """Number of fastq pairs processed at the same time
+
+    settings["parallel_samples"], or cpu_count // threads if it is null.
+    """
+    threads = settings.get("cutadapt_threads") or settings["threads"]
+    workers = settings.get("parallel_samples") or (os.cpu_count() or 1) // threads
+    return max(1, min(n_pairs, workers))
+
+def _pair_threads(settings: Dict, n_pairs: int) -> int:
+    """Threads of one cutadapt process
+
+    settings["cutadapt_threads"], or threads divided among the pairs if it is null.
+    """
+    return settings.get("cutadapt_threads") \
+        or max(1, settings["threads"] // _parallel_pairs(settings, n_pairs))
+
+def _run_commands(commands: List[List[str]], settings: Dict, logger: logging.Logger) -> None:
+    """Execute cutadapt commands, in threads if parallel_samples > 1
+
+    Arguments:
+        commands(list of list of str): command line of each pair
+        settings(dict): settings from yaml
+        logger(logging.Logger): logger of the caller
+    """
+    def run(command_line: List[str]) -> None:
+        logger.debug("execute {}".format(command_line))
+        try:
+            # execute proc and wait
+            proc = subprocess.run(
+                command_line,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT
+            )
+        except OSError as e:
+            logger.exception(e)
+            raise e
+        msg = proc.stdout.decode(errors="replace")
+        if proc.returncode:
+            logger.error(msg)
+            logger.error("cutadapt returns {}".format(proc.returncode))
+        else:
+            logger.debug(msg)
+
+    workers = _parallel_pairs(settings, len(commands))
+    if workers > 1:
+        # cutadapt runs in subprocess, so threads are enough
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(run, commands))
+    else:
+        for command_line in commands:
+            run(command_line)
+
 def cutadapt_tag(
     R1_fastq: List[PathStr],
     R2_fastq: List[PathStr],
     forward_tag: PathStr,
     reverse_tag: PathStr,
     destination: PathStr,
+    settings: Dict,
 ) -> None:
     """Run cutadapt to recognize tag
 
@@ -22,6 +79,7 @@ def cutadapt_tag(
         forward_tag(PathStr): path to the forward(R1) tag 
         reverse_tag(PathStr): path to the reverse(R2) tag
         destination(PathStr): path to the data folder
+        settings(dict): settings from yaml
     """
     logger = logging.getLogger("all_in.cutadapt")
     logger.debug("cutadapt_tag called.")
@@ -33,11 +91,12 @@ def cutadapt_tag(
     if not os.path.exists(tag_removed_path):
         os.makedirs(tag_removed_path)
 
-    # run cutadapt
+    # Create command for each pair
+    commands = []
     for R1, R2 in zip(R1_fastq, R2_fastq):
         # get filename
-        R1_name = R1.split('/')[-1].split('.')[0]
-        R2_name = R2.split('/')[-1].split('.')[0]
+        R1_name = fastq_name(R1)
+        R2_name = fastq_name(R2)
         # Create command for cutadapt
         command_line = [
             "python3",
@@ -45,6 +104,10 @@ def cutadapt_tag(
             "cutadapt",
             "--no-indels",
             "--discard-untrimmed",
+            "--compression-level",
+            str(settings["gzip"]["level"]),
+            "-j",
+            str(_pair_threads(settings, len(R1_fastq))),
             "-g",
             "file:{}".format(forward_tag),
             "-G",
@@ -52,36 +115,16 @@ def cutadapt_tag(
             "-y",
             r" {name}",
             "-o",
-            "{}/tag_removed/{}.fastq".format(destination, R1_name),
+            os.path.join(tag_removed_path, R1_name) + ".fastq",
             "-p",
-            "{}/tag_removed/{}.fastq".format(destination, R2_name),
+            os.path.join(tag_removed_path, R2_name) + ".fastq",
             R1,
             R2
         ]
-        logger.debug("execute {}".format(command_line))
+        commands.append(command_line)
 
-        # variables for return of proc
-        msg = None
-        return_code = None
-        try:
-            # execute proc
-            proc = subprocess.Popen(
-            command_line,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT
-            )
-
-            # get return from proc
-            msg = proc.stdout.read().decode()
-            return_code = proc.wait()
-        except OSError as e:
-            logger.error(msg) if msg else None
-            logger.error("cutadapt returns {}".format(return_code)) if return_code else None
-            logger.exception(e)
-            raise e
-        else:
-            return_code = proc.wait()
-            logger.debug(msg)
+    # Execute cutadapt for each pair
+    _run_commands(commands, settings, logger)
 
 def cutadapt_primer(
     R1_fastq: List[PathStr],
@@ -89,6 +132,7 @@ def cutadapt_primer(
     forward_primer: PathStr,
     reverse_primer: PathStr,
     destination: PathStr,
+    settings: Dict,
 ) -> None:
     """Run cutadapt to remove common primers
 
@@ -100,6 +144,7 @@ def cutadapt_primer(
         forward_primer(PathStr): path to the forward(R1) tag 
         reverse_primer(PathStr): path to the reverse(R2) tag
         destination(PathStr): path to the data folder
+        settings(dict): settings from yaml
     """
     logger = logging.getLogger("all_in.cutadapt")
     logger.debug("cutadapt_primer called.")
@@ -111,11 +156,12 @@ def cutadapt_primer(
     if not os.path.exists(primer_removed_path):
         os.makedirs(primer_removed_path)
 
-    # run cutadapt
+    # Create command for each pair
+    commands = []
     for R1, R2 in zip(R1_fastq, R2_fastq):
         # get filename
-        R1_name = R1.split('/')[-1].split('.')[0]
-        R2_name = R2.split('/')[-1].split('.')[0]
+        R1_name = fastq_name(R1)
+        R2_name = fastq_name(R2)
         # Create command for cutadapt
         command_line = [
             "python3",
@@ -123,39 +169,22 @@ def cutadapt_primer(
             "cutadapt",
             "--no-indels",
             "--discard-untrimmed",
+            "--compression-level",
+            str(settings["gzip"]["level"]),
+            "-j",
+            str(_pair_threads(settings, len(R1_fastq))),
             "-g",
             "file:{}".format(forward_primer),
             "-G",
             "file:{}".format(reverse_primer),
             "-o",
-            "{}/primer_removed/{}.fastq".format(destination, R1_name),
+            os.path.join(primer_removed_path, R1_name) + ".fastq",
             "-p",
-            "{}/primer_removed/{}.fastq".format(destination, R2_name),
+            os.path.join(primer_removed_path, R2_name) + ".fastq",
             R1,
             R2
         ]
-        logger.debug("execute {}".format(command_line))
-
-        # variables for return of proc
-        msg = None
-        return_code = None
-
-        try:
-            # execute proc
-            proc = subprocess.Popen(
-            command_line,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT
-            )
+        commands.append(command_line)
 
-            # get return from proc
-            msg = proc.stdout.read().decode()
-            return_code = proc.wait()
-        except OSError as e:
-            logger.error(msg) if msg else None
-            logger.error("cutadapt returns {}".format(return_code)) if return_code else None
-            logger.exception(e)
-            raise e
-        else:
-            return_code = proc.wait()
-            logger.debug(msg)
\ No newline at end of file
+    # Execute cutadapt for each pair
+    _run_commands(commands, settings, logger)
@@ -1,27 +1,40 @@
 """Demultiplex paired-end fastq file after fastp.
 
 Note:
-    dependencies(numpy, pandas)
+    dependencies(dnaio, numpy, pandas)
+    dnaio is installed together with cutadapt.
+    orjson is used for cells.json if it is installed.
     This script can't handle the interleave format.
 """
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import json
 import logging
 import os
 import sys
-from typing import List , NewType
+from typing import Dict, List , NewType, Optional
 
+import dnaio
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+from all_in_tools.fastq_io import fastq_name, open_fastq
 from all_in_tools.my_types import *
 
+# Buffered reads of one cell are written when the buffer has this many pairs
+FLUSH_READS = 4096
+
 def demultiplex(
     R1_fastq: List[PathStr],
     R2_fastq: List[PathStr],
     cells_json: PathStr,
     destination: PathStr,
+    settings: Optional[Dict] = None,
 ) -> None:
     """Demultiplex fastq file (after fastp)
 
@@ -30,6 +43,7 @@ def demultiplex(
         R2_fastq(PathStr): path to the after-fastp R2 sequence
         destination(PathStr): path to the data folder
         cells_json(PathStr): path to ``cells.json``
+        settings(dict, optional): settings from yaml (gzip section is used)
     """
 
     logger = logging.getLogger("all_in.demultiplex")
@@ -37,128 +51,108 @@ def demultiplex(
 
     # Load cell names
     try:
-        with open(cells_json, 'rt') as f:
-            cells = json.load(f)
+        with open(cells_json, 'rb') as f:
+            cells = orjson.loads(f.read()) if orjson is not None else json.load(f)
     except FileNotFoundError as e:
         logger.exception(e)
         logger.fatal("Can't open cell list. Abort.")
         sys.exit(1)
     
+    # R1 tag name: {R2 tag name: cell name}
+    # (reads are looked up by R1 tag first, so no tuple key is built per read
+    #  and R2 header is not split if R1 tag is unknown)
+    name_to_cell: Dict[str, Dict[str, str]] = dict()
+    for cell, pairs in cells.items():
+        for pair in pairs:
+            name_to_cell.setdefault(pair[0], dict())[pair[1]] = cell
+
     for R1, R2 in zip(R1_fastq, R2_fastq):
         # get filename
-        R1_name = R1.split('/')[-1].split('.')[0]
-        R2_name = R2.split('/')[-1].split('.')[0]
-
-        # Read two fastq file
-        # Fastq files generated by fastp has one blank line at the end,
-        # so we need all lines in the fastq file except the last line.
-        # Because of this, split('\n')[:-1] is used here.
-        with open(R1, 'rt') as f_r1, open(R2, 'rt') as f_r2:
-            fastq_r1 = f_r1.read().split('\n')[:-1]
-            fastq_r2 = f_r2.read().split('\n')[:-1]
-
-        # ensure both R1 and R2 have same length
+        R1_name = fastq_name(R1)
+        R2_name = fastq_name(R2)
+
+        # Prepare output files
+        # destination/
+        #   |-cells/
+        #       |-1A01/
+        #       |   |-R1.fastq
+        #       |   |-R2.fastq
+        #       |-1A02/
+        #       ...
+        out_path = dict()
+        for cell in cells.keys():
+            path = destination + '/cells/' + cell
+            os.makedirs(path) if not os.path.exists(path) else None
+            out_path[cell] = (
+                path + '/{}.fastq'.format(R1_name),
+                path + '/{}.fastq'.format(R2_name)
+            )
+            # truncate (records are appended below)
+            for p in out_path[cell]:
+                open(p, 'wb').close()
+
+        # Reads waiting to be written, and the number of reads of each cell
+        buffers = {cell: list() for cell in cells.keys()}
+        counts = {cell: 0 for cell in cells.keys()}
+
+        def _flush(cell: str) -> None:
+            """Append buffered reads of the cell to its fastq files."""
+            r1_path, r2_path = out_path[cell]
+            with open_fastq(r1_path, 'ab', settings) as f_r1, \
+                open_fastq(r2_path, 'ab', settings) as f_r2, \
+                dnaio.open(f_r1, file2=f_r2, mode='w', fileformat="fastq") as writer:
+                for r1, r2 in buffers[cell]:
+                    writer.write(r1, r2)
+            buffers[cell].clear()
+
+        # Read paired reads and split them into the cells.
+        # The tag name is the last word of the header (added by cutadapt_tag).
+        # dnaio raises FileFormatError if R1 and R2 are not paired properly.
         try:
-            assert len(fastq_r1) == len(fastq_r2)
-        except AssertionError as e:
-            logger.fatal(
-                "R1({} lines) != R2({} lines)".format(len(fastq_r1), len(fastq_r2))
-                )
+            with open_fastq(R1, 'rb', settings) as f_r1, \
+                open_fastq(R2, 'rb', settings) as f_r2, \
+                dnaio.open(f_r1, file2=f_r2, mode='r') as reader:
+                for r1, r2 in tqdm(reader, desc="split into the cell", unit="reads"):
+                    r2_to_cell = name_to_cell.get(r1.name.rsplit(" ", 1)[-1])
+                    if r2_to_cell is None:
+                        continue
+                    cell = r2_to_cell.get(r2.name.rsplit(" ", 1)[-1])
+                    if cell is None:
+                        continue
+                    counts[cell] += 1
+                    buffers[cell].append((r1, r2))
+                    if len(buffers[cell]) >= FLUSH_READS:
+                        _flush(cell)
+        except dnaio.FileFormatError as e:
+            logger.fatal("{} and {} are not paired properly".format(R1, R2))
             logger.exception(e)
             exit(1)
-        else:
-            fastq_length = len(fastq_r1)
-            logger.debug(
-                "fastq length assertion OK.(length={})".format(fastq_length)
-                )
-        
-        # Convert fastq into DataFrame via dict
-        dict_r1 = {
-            "R1_fullname" : [fastq_r1[i] for i in range(0,fastq_length,4)],
-            "R1_name"     : [fastq_r1[i].split(" ")[-1] for i in range(0,fastq_length,4)],
-            "R1_sequence" : [fastq_r1[i+1] for i in range(0,fastq_length,4)],
-            "R1_quality"  : [fastq_r1[i+3] for i in range(0,fastq_length,4)]
-        }
-        dict_r2 = {
-            "R2_fullname" : [fastq_r2[i] for i in range(0,fastq_length,4)],
-            "R2_name"     : [fastq_r2[i].split(" ")[-1] for i in range(0,fastq_length,4)],
-            "R2_sequence" : [fastq_r2[i+1] for i in range(0,fastq_length,4)],
-            "R2_quality"  : [fastq_r2[i+3] for i in range(0,fastq_length,4)]
-        }
-        sequence_df = pd.concat(
-            [pd.DataFrame(dict_r1), pd.DataFrame(dict_r2)],
-            axis=1
-        )
-        sequence_df.to_csv(f"log/{R1_name[:-1]}.csv")
-        logger.debug(sequence_df.head())
-
-        # split sequence_df into cell dfs
-        # {
-        #   "1A01" : dataframe contains sequences from 1A01,
-        #   "1A02" : dataframe contains sequences from 1A02,
-        #   ...
-        # }
-        cell_dfs = {
-            k: sequence_df.query(
-                " or".join(
-                    ["(R1_name == '{}' and R2_name == '{}')".format(pair[0],pair[1]) \
-                        for pair in cells[k]]
-                    )
-            ) for k in tqdm(cells.keys(), desc="sprit into the cell")
-        }
+
+        # Write the rest
+        # (each cell has its own files, so cells are written in threads)
+        rest = [cell for cell in cells.keys() if buffers[cell]]
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            list(tqdm(executor.map(_flush, rest), total=len(rest), desc="save fastq"))
 
         # Count sequences in each cell
-        plate = [
-            pd.DataFrame(
-                np.zeros((8,12),dtype=int), 
-                index=["A","B", "C", "D", "E", "F", "G", "H"], 
-                columns=["01", "02", "03", "04", "05", "06", "07", "08", "09", "10", "11", "12"]
-            ) for _ in range(0,6)
-        ]
+        # (plate No., row, column), wrapped in DataFrame only for print/csv
+        rows = ["A", "B", "C", "D", "E", "F", "G", "H"]
+        columns = ["01", "02", "03", "04", "05", "06", "07", "08", "09", "10", "11", "12"]
+        plate = np.zeros((6, 8, 12), dtype=int)
         empty_cells = list()
-        for cell, df in cell_dfs.items():
-            plate_no = int(cell[0])-1
-            row = cell[1]
-            col = cell[2:4]
-            plate[plate_no].at[row, col] = len(df)
-            if len(df) == 0:
+        for cell, count in counts.items():
+            plate[int(cell[0])-1, rows.index(cell[1]), int(cell[2:4])-1] = count
+            if count == 0:
                 empty_cells.append(cell)
 
         # Print plate shape
         for i in range(0,6):
+            plate_df = pd.DataFrame(plate[i], index=rows, columns=columns)
             print("\t==== Reads in plate No. {} ====".format(i+1))
-            print(plate[i])
-            logger.debug("\t==== Reads in plate No. {} ====\n{}".format(i+1, plate[i]))
-            plate[i].to_csv(f"log/{R1_name[:-1]}_{i}.csv")
+            print(plate_df)
+            logger.debug("\t==== Reads in plate No. {} ====\n{}".format(i+1, plate_df))
+            plate_df.to_csv(f"log/{R1_name[:-1]}_{i}.csv")
         else:
             print("Empty cells : {}".format(empty_cells))
 
-        logger.info("empty cells : {} out of {}".format(len(empty_cells), len(cell_dfs)))
-        # Save data
-        # destination/
-        #   |-cells/
-        #       |-1A01/
-        #       |   |-R1.fastq
-        #       |   |-R2.fastq
-        #       |-1A02/
-        #       ...
-        for cell, df in tqdm(cell_dfs.items(), desc="save fastq"):
-            path = destination + '/cells/' + cell
-            os.makedirs(path) if not os.path.exists(path) else None
-
-            with open(path + '/{}.fastq'.format(R1_name), 'wt') as f_r1, \
-                open(path + '/{}.fastq'.format(R2_name), 'wt') as f_r2:
-
-                for _, row in df.iterrows():
-                    # Reproduce the sequence in fastq format
-                    r1_seq = '\n'.join(
-                        [row.R1_fullname, row.R1_sequence, '+', row.R1_quality]
-                    )
-                    r2_seq = '\n'.join(
-                        [row.R2_fullname, row.R2_sequence, '+', row.R2_quality]
-                    )
-                    
-                    # Write sequence
-                    f_r1.write(r1_seq + '\n')
-                    f_r2.write(r2_seq + '\n')
-
+        logger.info("empty cells : {} out of {}".format(len(empty_cells), len(counts)))
@@ -4,6 +4,7 @@ import shutil
 import subprocess
 from typing import Dict, List
 
+from all_in_tools.fastq_io import fastq_name
 from all_in_tools.my_types import *
 
 def fastp(
@@ -38,8 +39,8 @@ def fastp(
     # Run fastp
     for R1, R2 in zip(R1_fastq, R2_fastq):
         # Get filename
-        R1_name = R1.split('/')[-1].split('.')[0]
-        R2_name = R2.split('/')[-1].split('.')[0]
+        R1_name = fastq_name(R1)
+        R2_name = fastq_name(R2)
         # Get common name
         common_name = os.path.commonprefix([R1_name, R2_name])
 
@@ -56,33 +57,32 @@ def fastp(
             os.path.join(fastp_path, R2_name) + ".fastq",
             "-h",
             os.path.join(fastp_path, common_name) + ".html",
+            "-z",
+            str(settings["gzip"]["level"]),
+            "--thread",
+            str(min(settings.get("fastp_threads") or settings["threads"], 16)),
             *settings["fastp"]
         ]
         logger.debug("execute {}".format(command_line))
 
-        # variables for return of proc
-        msg = None
-        return_code = None
-
         try:
-            # execute proc
-            proc = subprocess.Popen(
-            command_line,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT
+            # execute proc and wait
+            proc = subprocess.run(
+                command_line,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT
             )
-
-            # get return from proc
-            msg = proc.stdout.read().decode()
-            return_code = proc.wait()
         except OSError as e:
-            logger.error(msg) if msg else None
-            logger.error("fastp returns {}".format(return_code)) if return_code else None
             logger.exception(e)
             raise e
         else:
-            return_code = proc.wait()
-            logger.info(msg)
+            msg = proc.stdout.decode(errors="replace")
+            if proc.returncode:
+                logger.error(msg)
+                logger.error("fastp returns {}".format(proc.returncode))
+            else:
+                logger.info(msg)
             shutil.copy(
                 os.path.join(fastp_path, common_name) + ".html",
                 report_dest
@@ -0,0 +1,75 @@
+"""Open (gzipped) fastq files for all_in.py
+
+Note:
+    xopen is installed together with cutadapt.
+    If python-isal is also installed, xopen compresses/decompresses gzip by ISA-L.
+    If rapidgzip is installed, engine "rapidgzip" decompresses gzip in parallel
+    (compression still goes through xopen).
+    In all_in.py only demultiplex reads fastq by open_fastq, and the fastp output
+    it reads is plain .fastq, so rapidgzip is used only for gzipped demultiplex input.
+"""
+
+import gzip
+import io
+import os
+from typing import IO, Dict, Optional
+
+from xopen import xopen
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+from all_in_tools.my_types import *
+
+# Buffer size of uncompressed fastq written by all_in.py
+FASTQ_BUFSIZE = 1 << 20
+
+# Extensions xopen (de)compresses
+COMPRESSED_EXTS = (".gz", ".bz2", ".xz", ".zst")
+
+def open_fastq(path: PathStr, mode: str = 'rt', settings: Optional[Dict] = None) -> IO:
+    """Open fastq file (plain or gzipped) according to settings["gzip"].
+
+    Arguments:
+        path(PathStr): path to the fastq file
+        mode(str): mode passed to open ('rt', 'wt', 'rb', 'wb', ...)
+        settings(dict, optional): settings from yaml
+
+    Returns:
+        file object (use with the "with" statement)
+    """
+    gzip_settings = (settings or dict()).get("gzip", dict())
+    level = gzip_settings.get("level", 1)
+
+    engine = gzip_settings.get("engine", "isal")
+
+    if 'r' not in mode and not path.endswith(COMPRESSED_EXTS):
+        # Plain output: large buffer, so that writes of many small records are batched
+        return open(path, mode, buffering=FASTQ_BUFSIZE)
+    elif engine == "rapidgzip" and rapidgzip is not None \
+        and 'r' in mode and path.endswith(".gz"):
+        # Multi-threaded decompression (decompress_threads 0: all CPUs)
+        f = rapidgzip.open(path, parallelization=gzip_settings.get("decompress_threads", 0))
+        return f if 'b' in mode else io.TextIOWrapper(f)
+    elif engine in ("isal", "rapidgzip"):
+        return xopen(
+            path, mode,
+            compresslevel=level,
+            threads=gzip_settings.get("threads", 1)
+        )
+    elif path.endswith(".gz"):
+        return gzip.open(path, mode, compresslevel=level)
+    else:
+        return open(path, mode, buffering=FASTQ_BUFSIZE)
+
+def fastq_name(path: PathStr) -> str:
+    """Filename without directory and extensions (sample_R1.fastq.gz -> sample_R1).
+
+    Arguments:
+        path(PathStr): path to the fastq file
+
+    Returns:
+        str: name used for the output files
+    """
+    return os.path.basename(path).split('.', 1)[0]
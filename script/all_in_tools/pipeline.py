@@ -0,0 +1,172 @@
+"""Trimming and quality filtering connected by pipes.
+
+cutadapt(tag) -> cutadapt(primer) -> fastp run at the same time,
+and the reads are streamed between them as interleaved fastq.
+Therefore tag_removed/primer_removed fastq files are never written.
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from typing import Dict, List
+
+from all_in_tools.fastq_io import fastq_name
+from all_in_tools.my_types import *
+
+# cutadapt(tag), cutadapt(primer) and fastp run at the same time
+PIPELINE_STAGES = 3
+
+def _stage_threads(settings: Dict, key: str) -> int:
+    """Threads of one process in the pipeline
+
+    settings[key], or threads divided among the processes of the pipeline if it is null.
+    """
+    return settings.get(key) or max(1, settings["threads"] // PIPELINE_STAGES)
+
+def run_trim_qc_pipeline(
+    R1_fastq: List[PathStr],
+    R2_fastq: List[PathStr],
+    forward_tag: PathStr,
+    reverse_tag: PathStr,
+    forward_primer: PathStr,
+    reverse_primer: PathStr,
+    destination: PathStr,
+    report_dest: PathStr,
+    settings: Dict,
+) -> None:
+    """Run cutadapt_tag, cutadapt_primer and fastp as one pipeline
+
+    Results are same as cutadapt.cutadapt_tag -> cutadapt.cutadapt_primer -> fastp.fastp,
+    except that only destination/fastp has fastq files.
+
+    Arguments:
+        R1_fastq(list of PathStr): path to the raw R1 sequence
+        R2_fastq(list of PathStr): path to the raw R2 sequence
+        forward_tag(PathStr): path to the forward(R1) tag
+        reverse_tag(PathStr): path to the reverse(R2) tag
+        forward_primer(PathStr): path to the forward(R1) primer
+        reverse_primer(PathStr): path to the reverse(R2) primer
+        destination(PathStr): path to the data folder
+        report_dest(PathStr): path to the nginx html folder
+        settings(dict): settings from yaml
+    """
+    logger = logging.getLogger("all_in.pipeline")
+    logger.debug("run_trim_qc_pipeline called.")
+
+    # Prepare destination directory
+    fastp_path = os.path.join(
+        destination, "fastp"
+    )
+    if not os.path.exists(fastp_path):
+        os.makedirs(fastp_path)
+    if not os.path.exists(report_dest):
+        os.makedirs(report_dest)
+
+    for R1, R2 in zip(R1_fastq, R2_fastq):
+        # Get filename
+        R1_name = fastq_name(R1)
+        R2_name = fastq_name(R2)
+        # Get common name
+        common_name = os.path.commonprefix([R1_name, R2_name])
+
+        # Create commands
+        # tag: paired fastq -> interleaved stdout
+        # primer: interleaved stdin -> interleaved stdout
+        # fastp: interleaved stdin -> paired fastq
+        tag_command = [
+            "python3",
+            "-m",
+            "cutadapt",
+            "--interleaved",
+            "--no-indels",
+            "--discard-untrimmed",
+            "-j",
+            str(_stage_threads(settings, "cutadapt_threads")),
+            "-g",
+            "file:{}".format(forward_tag),
+            "-G",
+            "file:{}".format(reverse_tag),
+            "-y",
+            r" {name}",
+            R1,
+            R2
+        ]
+        primer_command = [
+            "python3",
+            "-m",
+            "cutadapt",
+            "--interleaved",
+            "--no-indels",
+            "--discard-untrimmed",
+            "-j",
+            str(_stage_threads(settings, "cutadapt_threads")),
+            "-g",
+            "file:{}".format(forward_primer),
+            "-G",
+            "file:{}".format(reverse_primer),
+            "-"
+        ]
+        fastp_command = [
+            "fastp",
+            "--stdin",
+            "--interleaved_in",
+            "-o",
+            os.path.join(fastp_path, R1_name) + ".fastq",
+            "-O",
+            os.path.join(fastp_path, R2_name) + ".fastq",
+            "-h",
+            os.path.join(fastp_path, common_name) + ".html",
+            "-z",
+            str(settings["gzip"]["level"]),
+            "--thread",
+            str(min(_stage_threads(settings, "fastp_threads"), 16)),
+            *settings["fastp"]
+        ]
+        commands = [tag_command, primer_command, fastp_command]
+        names = ["cutadapt(tag)", "cutadapt(primer)", "fastp"]
+        logger.debug("execute {}".format(" | ".join(str(c) for c in commands)))
+
+        # Messages of each process are written into temporary files,
+        # so that a full stderr pipe never blocks the pipeline.
+        logs = [tempfile.TemporaryFile() for _ in commands]
+        procs = []
+        try:
+            # Start processes and connect stdout to the next stdin
+            for i, command in enumerate(commands):
+                procs.append(
+                    subprocess.Popen(
+                        command,
+                        stdin=procs[-1].stdout if procs else None,
+                        stdout=subprocess.PIPE if i < len(commands) - 1 else logs[i],
+                        stderr=logs[i]
+                    )
+                )
+                # Close our copy so that the writer gets SIGPIPE if the reader dies
+                if i > 0:
+                    procs[i-1].stdout.close()
+
+            # Wait until all processes finish
+            return_codes = [proc.wait() for proc in procs]
+        except OSError as e:
+            for proc in procs:
+                proc.kill()
+            logger.exception(e)
+            raise e
+        else:
+            for name, log, return_code in zip(names, logs, return_codes):
+                log.seek(0)
+                msg = log.read().decode()
+                if return_code:
+                    logger.error(msg)
+                    logger.error("{} returns {}".format(name, return_code))
+                else:
+                    logger.debug(msg)
+            shutil.copy(
+                os.path.join(fastp_path, common_name) + ".html",
+                report_dest
+            )
+        finally:
+            for log in logs:
+                log.close()
@@ -14,10 +14,34 @@ if __name__ == "__main__":
 else:
     from all_in_tools.my_types import *
 
+# Size of chunks read by _count_lines
+COUNT_BUFSIZE = 1 << 20
+
+def _count_lines(path: PathStr) -> int:
+    """Count lines of the file without loading it.
+
+    Arguments:
+        path(PathStr): path to the file
+
+    Returns:
+        int: number of lines (the last line may lack the newline)
+    """
+    count = 0
+    last = b'\n'
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(COUNT_BUFSIZE)
+            if not chunk:
+                break
+            count += chunk.count(b'\n')
+            last = chunk[-1:]
+    return count if last == b'\n' else count + 1
+
 def save_result(
     blast_result: Dict[str, Optional[BlastResultInfo]],
     out_csv_path: PathStr,
-    filter_query: Optional[str] = None
+    filter_query: Optional[str] = None,
+    R1_name: Optional[List[str]] = None
     ) -> None:
     """Convert dict of BlastResultInfo into readable csv.
 
@@ -25,17 +49,26 @@ def save_result(
         blast_result(Dict[str, Optional[BlastResultInfo]]): returns from blast.blast_*
         out_csv_path(PathStr): path to result.csv
         filter_query(Optional[str]): query for filtering result
+        R1_name(Optional[list of str]): R1 fastq filenames in each cell
+            (raw sequences are counted from them, default: tmp_R1.fastq)
     """
     logger = logging.getLogger("all_in.save_result")
     logger.debug("save_result called")
-    result_df = pd.DataFrame(
-        None, columns=[
-            "plate", "cell", "candidate", "percent.ident.",
-            "length", "evalue", "bitscore", "query_seq",
-            "query_file", "from_intersection", "raw_count",
-            "query_count", "other_candidates"
-        ]
-    )
+    columns = [
+        "plate", "cell", "candidate", "percent.ident.",
+        "length", "evalue", "bitscore", "query_seq",
+        "query_file", "from_intersection", "raw_count",
+        "query_count", "other_candidates"
+    ]
+    # Rows of result_df (the DataFrame is built once after the loop)
+    rows: List[Dict] = list()
+    # path: number of lines (files shared by several results are read once)
+    line_counts: Dict[PathStr, int] = dict()
+
+    def count_lines(path: PathStr) -> int:
+        if path not in line_counts:
+            line_counts[path] = _count_lines(path)
+        return line_counts[path]
 
     for cell, info in blast_result.items():
         # Continue if there is no result
@@ -48,18 +81,19 @@ def save_result(
         else:
             cell_path = os.path.dirname(info.query_file)
 
-        with open(os.path.join(cell_path, "tmp_R1.fastq"), "rt") as f:
-            raw_count = len(f.read().split('\n'))//4
+        # (tmp_R1.fastq is not written if a cell has one pair, or with assembly_fifo)
+        raw_count = sum(
+            count_lines(os.path.join(cell_path, name)) // 4
+            for name in (R1_name or ["tmp_R1.fastq"])
+        )
         
         # Count query sequences
         if info.intersection:
-            query_count = 0
-            for q in info.query_file.split(':'):
-                with open(q, "rt") as f:
-                    query_count += len(f.read().split('\n'))//2
+            query_count = sum(
+                count_lines(q) // 2 for q in info.query_file.split(':')
+            )
         else:
-            with open(info.query_file, "rt") as f:
-                query_count = len(f.read().split('\n'))//2
+            query_count = count_lines(info.query_file) // 2
         
 
         # Separate top and other candidate
@@ -82,10 +116,11 @@ def save_result(
             "from_intersection": info.intersection,
             "other_candidates": list(other_candidate.loc[:,"saccver"])
         }
-        row_series = pd.Series(row_dict)
-        logger.debug(row_series)
-        result_df = result_df.append(row_series, ignore_index=True)
+        logger.debug(row_dict)
+        rows.append(row_dict)
     else:
+        result_df = pd.DataFrame(rows, columns=columns)
+
         # Sort result
         result_df.sort_values(["plate", "cell"], inplace=True)
 